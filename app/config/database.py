@@ -1,26 +1,151 @@
-from sqlalchemy import create_engine
+import asyncio
+import itertools
+import logging
+from sqlalchemy import create_engine, text
 from sqlalchemy.orm import sessionmaker, declarative_base
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
 from settings import settings
-from typing import Generator
+from app.utils.pool_stats import TimedQueuePool, TimedAsyncQueuePool
+from typing import AsyncGenerator
 
+logger = logging.getLogger(__name__)
 
-engine = create_engine(settings.DATABASE, echo=False)
+
+def async_database_url(url: str) -> str:
+    '''Maps a sync database url onto the matching asyncio driver'''
+
+    for prefix, async_prefix in (
+        ('postgresql+psycopg2://', 'postgresql+asyncpg://'),
+        ('postgresql://', 'postgresql+asyncpg://'),
+        ('postgres://', 'postgresql+asyncpg://'),
+        ('sqlite://', 'sqlite+aiosqlite://'),
+    ):
+        if url.startswith(prefix):
+            return async_prefix + url[len(prefix):]
+    return url
+
+
+def pool_options(url: str, async_engine: bool = False) -> dict:
+    '''Pool settings from Settings, sizing only applies to queue pools (not sqlite)'''
+
+    options = {
+        'pool_pre_ping': settings.DB_POOL_PRE_PING,
+        'pool_recycle': settings.DB_POOL_RECYCLE,
+    }
+    if not url.startswith('sqlite'):
+        options.update({
+            'poolclass': TimedAsyncQueuePool if async_engine else TimedQueuePool,
+            'pool_size': settings.DB_POOL_SIZE,
+            'max_overflow': settings.DB_MAX_OVERFLOW,
+            'pool_timeout': settings.DB_POOL_TIMEOUT,
+        })
+    return options
+
+
+# the sync engine is only used for DDL (create_models) and migrations, requests go through async_engine
+engine = create_engine(settings.DATABASE, echo=False, **pool_options(settings.DATABASE))
 
 SessionLocal = sessionmaker(
                         bind=engine,
                         autocommit = False,
-                        autoflush = False
+                        autoflush = False,
+                        expire_on_commit = False
+                        )
+
+ASYNC_DATABASE_URL = settings.ASYNC_DATABASE or async_database_url(settings.DATABASE)
+
+async_engine = create_async_engine(ASYNC_DATABASE_URL, echo=False, **pool_options(ASYNC_DATABASE_URL, async_engine=True))
+
+AsyncSessionLocal = async_sessionmaker(
+                        bind=async_engine,
+                        class_=AsyncSession,
+                        autoflush = False,
+                        expire_on_commit = False
                         )
 
 Base = declarative_base()
 
 
-def get_db() -> Generator:
+class ReplicaSet:
+    '''Round robin over the read replicas that passed the last health check.
+
+    The checks run every `check_interval` seconds in a background task (`start`), requests only read the result.
+    '''
+
+    def __init__(self, sessionmakers: list[async_sessionmaker], check_interval: float, check_timeout: float):
+        self.sessionmakers = sessionmakers
+        self.check_interval = check_interval
+        self.check_timeout = check_timeout
+        self.healthy = list(sessionmakers)
+        self._turn = itertools.count()
+        self._task: asyncio.Task | None = None
+
+    async def _ping(self, sessionmaker: async_sessionmaker) -> bool:
+        try:
+            async with sessionmaker() as session:
+                await asyncio.wait_for(session.execute(text('SELECT 1')), self.check_timeout)
+            return True
+        except Exception as e:
+            logger.warning('read replica %s failed its health check: %r', sessionmaker.kw['bind'].url, e)
+            return False
+
+    async def check(self) -> None:
+        results = await asyncio.gather(*(self._ping(sessionmaker) for sessionmaker in self.sessionmakers))
+        self.healthy = [sessionmaker for sessionmaker, ok in zip(self.sessionmakers, results) if ok]
+
+    async def _run(self) -> None:
+        while True:
+            await self.check()
+            await asyncio.sleep(self.check_interval)
+
+    def start(self) -> None:
+        if self.sessionmakers and self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def mark_down(self, sessionmaker: async_sessionmaker) -> None:
+        '''Stop routing to a replica that failed mid request until the next health check clears it'''
+
+        self.healthy = [healthy for healthy in self.healthy if healthy is not sessionmaker]
+
+    def pick(self) -> async_sessionmaker | None:
+        '''A healthy replica, or None when reads have to go to the primary'''
+
+        healthy = self.healthy
+        return healthy[next(self._turn) % len(healthy)] if healthy else None
+
+replicas = ReplicaSet(
+    [
+        async_sessionmaker(
+            bind=create_async_engine(async_database_url(url), echo=False, **pool_options(url, async_engine=True)),
+            class_=AsyncSession,
+            autoflush = False,
+            expire_on_commit = False,
+        )
+        for url in settings.DATABASE_REPLICA_URLS
+    ],
+    settings.DB_REPLICA_CHECK_INTERVAL,
+    settings.DB_REPLICA_CHECK_TIMEOUT,
+)
+
+
+async def get_db() -> AsyncGenerator[AsyncSession, None]:
     '''This function will yield a connection to the database everytime it called'''
     
-    db = SessionLocal()
-    try:
+    async with AsyncSessionLocal() as db:
         yield db
 
-    finally:
-        db.close()
+
+def get_sessionmaker() -> async_sessionmaker:
+    '''Session factory for work that outlives the request (streaming responses open their own session)'''
+
+    return AsyncSessionLocal
+
+
+def get_replica_set() -> ReplicaSet:
+    return replicas
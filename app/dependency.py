@@ -1,16 +1,60 @@
-from fastapi import Depends, status, HTTPException
+import hmac
+from fastapi import Depends, status, HTTPException, Request
 from fastapi.security import OAuth2PasswordBearer
-from typing import Annotated
-from app.config.database import get_db
-from sqlalchemy.orm import Session
+from typing import Annotated, AsyncGenerator
+from app.config.database import get_db, get_replica_set, ReplicaSet
+from sqlalchemy.exc import DBAPIError, OperationalError
+from sqlalchemy.ext.asyncio import AsyncSession
 from app.service.user_service import UserService
 from app.security.jwt_token import decode_access_token
+from app.security.rate_limit import token_subject
+from app.utils.response_cache import response_cache
+from app.utils.activity import activity
+from settings import settings
 
-DATABASE_OBJECT = Annotated[Session, Depends(get_db)]
+DATABASE_OBJECT = Annotated[AsyncSession, Depends(get_db)]
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+
+async def get_read_db(
+    request: Request,
+    db: DATABASE_OBJECT,
+    replica_set: Annotated[ReplicaSet, Depends(get_replica_set)],
+) -> AsyncGenerator[AsyncSession, None]:
+    '''Session for read only work, served by a healthy replica when one is configured.
+
+    Writes, requests from users who wrote in the last READ_YOUR_WRITES_SECONDS and requests arriving while
+    no replica is healthy get the primary session of `get_db` (which only connects when used).
+    '''
+
+    if request.method not in SAFE_METHODS:
+        yield db
+        return
+    subject = await token_subject(request)
+    if subject and await response_cache.wrote_recently(subject):
+        db.info['fresh'] = True                     # skip cached responses too, replicas may have filled them
+        yield db
+        return
+    sessionmaker = replica_set.pick()
+    if sessionmaker is None:
+        yield db
+        return
+
+    async with sessionmaker() as session:
+        session.info['replica'] = True
+        try:
+            yield session
+        except DBAPIError as e:
+            if e.connection_invalidated or isinstance(e, OperationalError):
+                replica_set.mark_down(sessionmaker)
+            raise
+
+READ_DATABASE_OBJECT = Annotated[AsyncSession, Depends(get_read_db)]
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="user/login")
 
-def get_current_user(token: Annotated[str, Depends(oauth2_scheme)], db: DATABASE_OBJECT):
+async def get_current_user(token: Annotated[str, Depends(oauth2_scheme)], db: READ_DATABASE_OBJECT):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
@@ -18,7 +62,18 @@ def get_current_user(token: Annotated[str, Depends(oauth2_scheme)], db: DATABASE
     )
     token_data = decode_access_token(token)
     _service = UserService(db)
-    user = _service.get_current_user(token_data.user_email)
+    user = await _service.get_current_user(token_data.user_email)
     if user is None:
         raise credentials_exception
-    return user
\ No newline at end of file
+    activity.seen(user.id)                          # written behind, coalesced per user
+    return user
+
+
+def internal_access(request: Request) -> None:
+    '''Operational endpoints need `Authorization: Bearer <INTERNAL_TOKEN>`, they are hidden (404) while no token is configured'''
+
+    if not settings.INTERNAL_TOKEN:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='Not Found')
+    scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+    if scheme.lower() != 'bearer' or not hmac.compare_digest(token.encode(), settings.INTERNAL_TOKEN.encode()):
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail='invalid internal token', headers={'WWW-Authenticate': 'Bearer'})
@@ -0,0 +1,21 @@
+from app.config.database import Base
+from sqlalchemy import Column, Integer, String, DateTime, Text, Index, func
+
+QUEUED, RUNNING, DEAD = 'queued', 'running', 'dead'
+
+
+class Job(Base):
+    __tablename__ = 'jobs'
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    kind = Column(String(64), nullable=False)
+    payload = Column(Text, nullable=False)                                      # JSON arguments of the handler
+    dedup_key = Column(String(191), unique=True, nullable=True)                 # released once the job finished or died
+    status = Column(String(16), default=QUEUED, nullable=False)
+    attempts = Column(Integer, default=0, nullable=False)
+    max_attempts = Column(Integer, nullable=False)
+    run_at = Column(DateTime, nullable=False)                                   # not before, pushed back by the retry backoff
+    locked_until = Column(DateTime, nullable=True)                              # lease of the worker running it
+    last_error = Column(Text, nullable=True)
+    created_at = Column(DateTime, server_default=func.now())
+
+    __table_args__ = (Index('ix_jobs_status_run_at', 'status', 'run_at'),)
@@ -0,0 +1,13 @@
+from app.config.database import Base
+from sqlalchemy import Column, Integer, String, Boolean, DateTime
+
+class LoginEvent(Base):
+    __tablename__ = 'login_events'
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    # set on successful logins, no foreign key: a batch flushed after an account was deleted must not fail, the trail is kept
+    user_id = Column(Integer, nullable=True, index=True)
+    email = Column(String(128), nullable=False, index=True)                     # as typed in the login form, failures are found by it
+    succeeded = Column(Boolean, nullable=False)
+    ip = Column(String(45), nullable=True)
+    user_agent = Column(String(256), nullable=True)
+    created_at = Column(DateTime, nullable=False, index=True)                   # time of the attempt, rows are inserted later in batches
@@ -0,0 +1,13 @@
+from app.config.database import Base
+from sqlalchemy import Column, Integer, String, Boolean, DateTime, ForeignKey, func
+
+class RefreshToken(Base):
+    __tablename__ = 'refresh_tokens'
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    user_id = Column(Integer, ForeignKey('users.id', ondelete='CASCADE'), nullable=False, index=True)
+    token_hash = Column(String(64), unique=True, nullable=False, index=True)     # sha256 of the token, the token itself is never stored
+    family = Column(String(32), nullable=False, index=True)                     # shared by every rotation of one login
+    expires_at = Column(DateTime, nullable=False)
+    used_at = Column(DateTime, nullable=True)                                   # set when rotated, a second use is a replay
+    revoked = Column(Boolean, default=False, nullable=False)
+    created_at = Column(DateTime, server_default=func.now())
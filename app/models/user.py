@@ -1,6 +1,6 @@
 from datetime import datetime
 from app.config.database import Base
-from sqlalchemy import Column, Integer, String, Boolean, DateTime, func, Text
+from sqlalchemy import Column, Integer, String, Boolean, DateTime, func, Text, DDL, event
 
 class User(Base):
     __tablename__ = 'users'
@@ -13,7 +13,39 @@ class User(Base):
     is_verified = Column(Boolean, default=False)
     bio = Column(Text, nullable=True)
     created_at = Column(DateTime, server_default=func.now())
-    updated_at = Column(DateTime, onupdate=func.now(), server_default=func.now())
+    updated_at = Column(DateTime, onupdate=datetime.now, server_default=func.now())    # microsecond precision, links are bound to it
+    last_login_at = Column(DateTime, nullable=True)                 # both written behind by app.utils.activity, a few seconds late
+    last_seen_at = Column(DateTime, nullable=True)
+
+    __mapper_args__ = {'eager_defaults': True}                  # fetch server generated timestamps with RETURNING
 
     def get_context(self):
         return f'{self.email}{self.updated_at}'.strip()
+
+
+# full text search over the profile, an expression GIN index on Postgres and an external content FTS5 table on SQLite
+SEARCH_COLUMNS = ('first_name', 'last_name', 'email', 'bio')
+SEARCH_DOCUMENT = "to_tsvector('simple', coalesce(first_name, '') || ' ' || coalesce(last_name, '') || ' ' || coalesce(email, '') || ' ' || coalesce(bio, ''))"
+
+POSTGRES_SEARCH_DDL = (
+    f'CREATE INDEX IF NOT EXISTS ix_users_search ON users USING gin ({SEARCH_DOCUMENT})',
+)
+
+_new = ', '.join(f'new.{column}' for column in SEARCH_COLUMNS)
+_old = ', '.join(f'old.{column}' for column in SEARCH_COLUMNS)
+SQLITE_SEARCH_DDL = (
+    f"CREATE VIRTUAL TABLE IF NOT EXISTS users_fts USING fts5({', '.join(SEARCH_COLUMNS)}, content='users', content_rowid='id')",
+    f"CREATE TRIGGER IF NOT EXISTS users_fts_ai AFTER INSERT ON users BEGIN "
+    f"INSERT INTO users_fts(rowid, {', '.join(SEARCH_COLUMNS)}) VALUES (new.id, {_new}); END",
+    f"CREATE TRIGGER IF NOT EXISTS users_fts_ad AFTER DELETE ON users BEGIN "
+    f"INSERT INTO users_fts(users_fts, rowid, {', '.join(SEARCH_COLUMNS)}) VALUES ('delete', old.id, {_old}); END",
+    f"CREATE TRIGGER IF NOT EXISTS users_fts_au AFTER UPDATE OF {', '.join(SEARCH_COLUMNS)} ON users BEGIN "
+    f"INSERT INTO users_fts(users_fts, rowid, {', '.join(SEARCH_COLUMNS)}) VALUES ('delete', old.id, {_old}); "
+    f"INSERT INTO users_fts(rowid, {', '.join(SEARCH_COLUMNS)}) VALUES (new.id, {_new}); END",
+)
+
+for statement in POSTGRES_SEARCH_DDL:
+    event.listen(User.__table__, 'after_create', DDL(statement).execute_if(dialect='postgresql'))
+for statement in SQLITE_SEARCH_DDL:
+    event.listen(User.__table__, 'after_create', DDL(statement).execute_if(dialect='sqlite'))
+event.listen(User.__table__, 'after_drop', DDL('DROP TABLE IF EXISTS users_fts').execute_if(dialect='sqlite'))
@@ -0,0 +1,25 @@
+from sqlalchemy import case, insert, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from datetime import datetime
+from app.models.login_event import LoginEvent
+from app.models.user import User
+
+
+class ActivityRepository:
+    '''Batched writes of the activity buffer, one INSERT and one UPDATE per flush whatever the batch size'''
+
+    def __init__(self, db: AsyncSession):
+        self.db = db
+
+    async def save(self, events: list[dict], last_login: dict[int, datetime], last_seen: dict[int, datetime]) -> None:
+        if events:
+            await self.db.execute(insert(LoginEvent).execution_options(render_nulls=True), events)     # one multi row INSERT, nulls do not split it
+        if last_login or last_seen:
+            # a CASE over the ids instead of UPDATE ... FROM (VALUES ...), SQLite cannot name the columns of a VALUES list
+            values = {'updated_at': User.updated_at}                        # not a profile change, ETags and links stay valid
+            if last_login:
+                values['last_login_at'] = case(last_login, value=User.id, else_=User.last_login_at)
+            if last_seen:
+                values['last_seen_at'] = case(last_seen, value=User.id, else_=User.last_seen_at)
+            await self.db.execute(update(User).where(User.id.in_(last_login.keys() | last_seen.keys())).values(**values))
+        await self.db.commit()
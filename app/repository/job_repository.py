@@ -0,0 +1,86 @@
+import json
+from sqlalchemy import and_, delete, insert, or_, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.asyncio import AsyncSession
+from datetime import datetime, timedelta
+from app.models.job import Job, QUEUED, RUNNING, DEAD
+
+
+class JobRepository:
+    '''Durable job queue on the jobs table, the same statements run on SQLite and Postgres'''
+
+    def __init__(self, db: AsyncSession):
+        self.db = db
+
+    async def enqueue(self, kind: str, payload: dict, max_attempts: int, dedup_key: str | None = None, delay: float = 0, commit: bool = True) -> bool:
+        '''Insert a job, False when a pending job already holds `dedup_key`.
+
+        With `commit=False` the job joins the open transaction and is only queued if the caller's write commits.
+        '''
+
+        values = dict(
+            kind=kind,
+            payload=json.dumps(payload),
+            dedup_key=dedup_key,
+            status=QUEUED,
+            attempts=0,
+            max_attempts=max_attempts,
+            run_at=datetime.now() + timedelta(seconds=delay),
+        )
+        dialect = self.db.get_bind().dialect.name
+        if dedup_key is not None and dialect in ('postgresql', 'sqlite'):
+            dialect_insert = postgresql.insert if dialect == 'postgresql' else sqlite.insert
+            statement = dialect_insert(Job).values(**values).on_conflict_do_nothing(index_elements=['dedup_key'])
+        else:
+            statement = insert(Job).values(**values)
+        result = await self.db.execute(statement)
+        if commit:
+            await self.db.commit()
+        return bool(result.rowcount)
+
+    async def claim(self, limit: int, lease: float) -> list:
+        '''Lease up to `limit` due jobs, including running ones whose worker let the lease expire.
+
+        One UPDATE over a locked subquery: SKIP LOCKED keeps concurrent workers apart on Postgres,
+        SQLite serializes writers so the statement is atomic there.
+        '''
+
+        now = datetime.now()
+        due = (
+            select(Job.id)
+            .where(or_(
+                and_(Job.status == QUEUED, Job.run_at <= now),
+                and_(Job.status == RUNNING, Job.locked_until < now),
+            ))
+            .order_by(Job.run_at)
+            .limit(limit)
+            .with_for_update(skip_locked=True)
+        )
+        result = await self.db.execute(
+            update(Job)
+            .where(Job.id.in_(due.scalar_subquery()))
+            .values(status=RUNNING, attempts=Job.attempts + 1, locked_until=now + timedelta(seconds=lease))
+            .returning(Job.id, Job.kind, Job.payload, Job.attempts, Job.max_attempts)
+        )
+        jobs = result.all()
+        await self.db.commit()
+        return jobs
+
+    async def complete(self, job_id: int) -> None:
+        await self.db.execute(delete(Job).where(Job.id == job_id))
+        await self.db.commit()
+
+    async def retry(self, job_id: int, delay: float, error: str) -> None:
+        await self.db.execute(
+            update(Job)
+            .where(Job.id == job_id)
+            .values(status=QUEUED, run_at=datetime.now() + timedelta(seconds=delay), locked_until=None, last_error=error)
+        )
+        await self.db.commit()
+
+    async def dead_letter(self, job_id: int, error: str) -> None:
+        # kept for inspection, the dedup key is released so the same work can be enqueued again
+        await self.db.execute(
+            update(Job).where(Job.id == job_id).values(status=DEAD, dedup_key=None, locked_until=None, last_error=error)
+        )
+        await self.db.commit()
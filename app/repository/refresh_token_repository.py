@@ -0,0 +1,51 @@
+from sqlalchemy import insert, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from datetime import datetime
+from app.models.refresh_token import RefreshToken
+from app.models.user import User
+
+
+class RefreshTokenRepository:
+    '''Refresh tokens are looked up by the sha256 of the token, every method issues a single statement'''
+
+    def __init__(self, db: AsyncSession):
+        self.db = db
+
+    async def create(self, user_id: int, token_hash: str, family: str, expires_at: datetime) -> None:
+        await self.db.execute(
+            insert(RefreshToken).values(user_id=user_id, token_hash=token_hash, family=family, expires_at=expires_at)
+        )
+        await self.db.commit()
+
+    async def consume(self, token_hash: str) -> tuple[int, str] | None:
+        '''Mark a live token as used and return its (user_id, family), None when it is unknown, expired, revoked or already used.
+
+        The conditional UPDATE makes concurrent rotations of one token race safely, only one of them gets the row back.
+        '''
+
+        now = datetime.now()
+        result = await self.db.execute(
+            update(RefreshToken)
+            .where(
+                RefreshToken.token_hash == token_hash,
+                RefreshToken.used_at.is_(None),
+                RefreshToken.revoked == False,
+                RefreshToken.expires_at > now,
+            )
+            .values(used_at=now)
+            .returning(RefreshToken.user_id, RefreshToken.family)
+        )
+        row = result.first()
+        return (row.user_id, row.family) if row else None
+
+    async def revoke_family_of(self, token_hash: str) -> None:
+        family = select(RefreshToken.family).where(RefreshToken.token_hash == token_hash).scalar_subquery()
+        await self.db.execute(update(RefreshToken).where(RefreshToken.family == family).values(revoked=True))
+        await self.db.commit()
+
+    async def revoke_user(self, email: str) -> None:
+        user_id = select(User.id).where(User.email == email).scalar_subquery()
+        await self.db.execute(
+            update(RefreshToken).where(RefreshToken.user_id == user_id, RefreshToken.revoked == False).values(revoked=True)
+        )
+        await self.db.commit()
@@ -1,118 +1,217 @@
-from sqlalchemy.orm import Session
-from app.models.user import User
+from sqlalchemy import and_, column, delete, func, insert, literal_column, or_, select, table, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import AsyncIterator, Mapping
+from datetime import datetime
+from app.models.user import User, SEARCH_DOCUMENT
 from app.schemas.request_schemas import UserInput, UserUpdate
 from app.schemas.response_schemas import UserOutput
-from app.security.hashing import verify_password
+from app.utils.cache import principal_cache
+from app.utils.response_cache import response_cache
+from app.security.jwt_token import evict_tokens
+
+USERS_FTS = table('users_fts', column('rowid'), column('rank'))             # SQLite search index, kept in sync by triggers
+
+# columns each visibility level may read, regular users only see the public profile
+PUBLIC_FIELDS = ('first_name', 'last_name', 'email', 'bio')
+SUPERUSER_FIELDS = ('id', 'first_name', 'last_name', 'email', 'is_superuser', 'bio', 'created_at')
+PRINCIPAL_FIELDS = ('id', 'first_name', 'last_name', 'email', 'bio')            # what regular users see of themselves
+
+
+async def _written(email: str, user_id: int | None = None, writer: str | None = None) -> None:
+    '''Drops what a write to this user makes stale: the cached principal (on other workers through its
+    generation) and cached responses.
+
+    `writer` (the acting principal, the user itself by default) reads from the primary for a while.
+    '''
+
+    principal_cache.invalidate(email)
+    await response_cache.mark_writer(writer or email)
+    await response_cache.bump(user_id, email)
+
 
 class UserRepository:
-    def __init__(self, db: Session):
+    '''Every method issues a single statement, services combine at most one read with one write'''
+
+    def __init__(self, db: AsyncSession):
         self.db = db
 
-    def user_exist(self, email: str) -> bool:
-        user_instance = self.db.query(User).filter(User.email == email, User.is_verified == True).first()
-        if user_instance:
-            return True
-        
-        return False
-    
-    def user_exist_with_email(self, email: str) -> bool:
-        user_instance = self.db.query(User).filter(User.email == email).first()
-        if user_instance:
-            return True
-        
-        return False
+    async def user_exist_with_email(self, email: str) -> bool:
+        result = await self.db.execute(select(User.id).where(User.email == email))
+        return result.first() is not None
     
-    def user_exist_by_id(self, id: int) -> bool:
-        user_instance = self.db.query(User).filter(User.id == id, User.is_verified == True).first()
-        if user_instance:
-            return True
-        
-        return False
-    
-    def create(self, user: UserInput) -> tuple[User | None, Exception | None]:
+    async def create(self, user: UserInput) -> tuple[User | None, Exception | None]:
         try:
             user_instance = User(**user.model_dump(exclude_none=True))
             self.db.add(user_instance)
-            self.db.commit()
-            self.db.refresh(user_instance)
+            await self.db.commit()                          # server defaults come back with the INSERT (eager_defaults)
         except Exception as e:
+            await self.db.rollback()
             return None, e
 
+        await response_cache.bump()
         return user_instance, None
     
-    def get_user_by_email(self, email) -> User:
-        user_instance = self.db.query(User).filter(User.email == email, User.is_verified == True).first()
-        return user_instance
+    async def existing_emails(self, emails: list[str]) -> set[str]:
+        result = await self.db.execute(select(User.email).where(User.email.in_(emails)))
+        return set(result.scalars().all())
+
+    async def bulk_create(self, users: list[dict], writer: str) -> None:
+        '''Multi-row INSERT of a whole batch, committed once'''
+
+        try:
+            await self.db.execute(insert(User), users)
+            await self.db.commit()
+        except Exception:
+            await self.db.rollback()
+            raise
+        await response_cache.mark_writer(writer)
+        await response_cache.bump()
     
-    def get_user_context(self, email) -> str:
-        user_instance = self.db.query(User).filter(User.email == email).first()
-        context_data = user_instance.get_context()
-        
-        return context_data
+    async def get_user_by_email(self, email: str, verified_only: bool = True) -> User | None:
+        query = select(User).where(User.email == email)
+        if verified_only:
+            query = query.where(User.is_verified == True)
+        result = await self.db.execute(query)
+        return result.scalars().first()
     
-    def verify_profile(self, email) -> dict:
-        user_instance = self.db.query(User).filter(User.email == email).first()
+    async def verify_profile(self, user_instance: User) -> dict:
         user_instance.is_verified = True
-
-        self.db.commit()
-        self.db.refresh(user_instance)
+        await self.db.commit()
+        await _written(user_instance.email, user_instance.id)
 
         return {'detail' : 'account verified, now you can login'}
 
-    def get_current_user(self, email: str) -> UserOutput:
-        user_instance = self.db.query(User).filter(User.email == email, User.is_verified == True).first()
-        user_dict = {key: value for key, value in user_instance.__dict__.items() if not key.startswith('_')}
-        user_model = UserOutput(**user_dict)
-        if not user_instance.is_superuser:
-            return  user_model.copy(update={'is_superuser': None, 'created_at': None})
-        
-        return user_model
+    async def get_current_user(self, email: str) -> UserOutput | None:
+        user_instance = await self.get_user_by_email(email)
+        if user_instance is None:
+            return None
+        fields = SUPERUSER_FIELDS if user_instance.is_superuser else PRINCIPAL_FIELDS
+        return UserOutput(updated_at=user_instance.updated_at, **{field: getattr(user_instance, field) for field in fields})
     
 
-    def authenticate_user(self, email: str, password: str) -> bool | User:
-        user_instance = self.db.query(User).filter(User.email == email, User.is_verified == True).first()
-        if not user_instance:
-            return False
-        if not verify_password(password, user_instance.password):
-            return False
-        return user_instance
-    
+    async def users_page(self, fields: list[str], super_user: bool, limit: int, after_id: int | None = None) -> tuple[list, bool]:
+        '''Keyset page ordered by id, selecting only `fields` (plus id for the cursor)'''
 
-    def all_users(self, exclude_id: int, super_user: bool) -> list[User]:
+        query = select(User.id, *(getattr(User, field) for field in fields if field != 'id'))
         if not super_user:
-            users = self.db.query(User.first_name, User.last_name, User.email, User.bio).filter(User.id != exclude_id, User.is_verified == True).all()
-            return users
-        
-        users = self.db.query(User).filter(User.id != exclude_id).all()
-        return users
+            query = query.where(User.is_verified == True)
+        if after_id is not None:
+            query = query.where(User.id > after_id)
+        result = await self.db.execute(query.order_by(User.id).limit(limit + 1))
+        rows = result.mappings().all()
+        return rows[:limit], len(rows) > limit
     
     
-    def get_user(self, user_id: int, super_user: bool) -> User:
+    async def search_users(self, fields: tuple[str, ...], super_user: bool, terms: list[str], limit: int, after: tuple[float, int] | None = None) -> tuple[list, bool]:
+        '''Users matching every prefix in `terms`, best match first, keyset paged on (score, id).
+
+        Served from the GIN index on Postgres and the FTS5 table on SQLite, higher scores are better on both.
+        '''
+
+        if self.db.get_bind().dialect.name == 'sqlite':
+            score = -USERS_FTS.c.rank                                   # bm25, lower is better
+            match = literal_column('users_fts').op('MATCH')(' '.join(f'"{term}"*' for term in terms))
+            query = select(User.id).select_from(USERS_FTS.join(User, User.id == USERS_FTS.c.rowid))
+        else:
+            tsquery = func.to_tsquery('simple', ' & '.join(f'{term}:*' for term in terms))
+            document = literal_column(SEARCH_DOCUMENT)                  # the indexed expression, verbatim
+            score = func.ts_rank_cd(document, tsquery)
+            match = document.op('@@')(tsquery)
+            query = select(User.id)
+
+        query = query.add_columns(*(getattr(User, field) for field in fields if field != 'id'), score.label('score')).where(match)
         if not super_user:
-            user = self.db.query(User.first_name, User.last_name, User.email, User.bio).filter(User.id == user_id, User.is_verified == True).first()
-            return user
-        
-        user = self.db.query(User).filter(User.id == user_id).first()
-        return user
+            query = query.where(User.is_verified == True)
+        if after is not None:
+            after_score, after_id = after
+            query = query.where(or_(score < after_score, and_(score == after_score, User.id > after_id)))
+        result = await self.db.execute(query.order_by(score.desc(), User.id).limit(limit + 1))
+        rows = result.mappings().all()
+        return rows[:limit], len(rows) > limit
+
+    async def stream_users(self, fields: tuple[str, ...], batch_size: int) -> AsyncIterator[list]:
+        '''Yields batches of rows from a server side cursor, the full result is never buffered'''
+
+        result = await self.db.stream(
+            select(*(getattr(User, field) for field in fields)).order_by(User.id).execution_options(yield_per=batch_size)
+        )
+        async for partition in result.mappings().partitions():
+            yield partition
     
-    def reset_password(self, email: str, new_password: str) -> dict:
-        user_instance = self.db.query(User).filter(User.email == email, User.is_verified == True).first()
-        user_instance.password = new_password
-        self.db.commit()
-        self.db.refresh(user_instance)
+    
+    async def get_user(self, user_id: int, super_user: bool) -> Mapping | None:
+        fields = SUPERUSER_FIELDS if super_user else PUBLIC_FIELDS
+        result = await self.db.execute(
+            select(*(getattr(User, field) for field in fields), User.updated_at).where(User.id == user_id, User.is_verified == True)
+        )
+        return result.mappings().first()
+
+    async def get_users(self, user_ids: list[int], super_user: bool) -> list[Mapping]:
+        '''The visible users among `user_ids` in one IN query, in no particular order'''
+
+        fields = SUPERUSER_FIELDS if super_user else PUBLIC_FIELDS
+        result = await self.db.execute(
+            select(User.id, *(getattr(User, field) for field in fields if field != 'id')).where(User.id.in_(user_ids), User.is_verified == True)
+        )
+        return result.mappings().all()
+
+    async def get_user_version(self, user_id: int) -> tuple[bool, datetime | None]:
+        '''Cheap lookup of updated_at for conditional requests, the flag tells whether the user exists'''
 
+        result = await self.db.execute(select(User.updated_at).where(User.id == user_id, User.is_verified == True))
+        row = result.first()
+        return row is not None, row[0] if row else None
+    
+    async def get_email(self, user_id: int) -> str | None:
+        result = await self.db.execute(select(User.email).where(User.id == user_id, User.is_verified == True))
+        return result.scalar_one_or_none()
+
+    async def reset_password(self, email: str, new_password: str) -> dict | None:
+        result = await self.db.execute(
+            update(User).where(User.email == email, User.is_verified == True).values(password=new_password).returning(User.id)
+        )
+        user_id = result.scalar_one_or_none()
+        await self.db.commit()
+        if user_id is None:
+            return None
+
+        await _written(email, user_id)
+        evict_tokens(email)
         return {'detail' : 'your password has been reset successfully'}
     
-    def update_data(self, email: str, data: UserUpdate):
-        self.db.query(User).filter(User.email == email, User.is_verified == True).update(data.model_dump(exclude_unset = True))
-        self.db.commit()
+    async def replace_password_hash(self, email: str, old_hash: str, new_hash: str) -> bool:
+        '''Swap in a rehash of the same password, unless the password changed meanwhile.
+
+        updated_at is kept so ETags and outstanding signed links stay valid, nothing visible changed.
+        '''
+
+        result = await self.db.execute(
+            update(User)
+            .where(User.email == email, User.password == old_hash)
+            .values(password=new_hash, updated_at=User.updated_at)
+        )
+        await self.db.commit()
+        return bool(result.rowcount)
+
+    async def update_data(self, email: str, data: UserUpdate):
+        result = await self.db.execute(
+            update(User).where(User.email == email, User.is_verified == True).values(**data.model_dump(exclude_unset = True)).returning(User.id)
+        )
+        user_id = result.scalar_one_or_none()
+        await self.db.commit()
+        if user_id is not None:
+            await _written(email, user_id)
         return
     
-    def verify_and_destroy(self, user_id: int):
-        user_instance = self.db.query(User).filter(User.id == user_id, User.is_verified == True).first()
-        if user_instance:
-            self.db.delete(user_instance)
-            self.db.commit()
-            return True
-        
-        return False
+    async def verify_and_destroy(self, user_id: int, writer: str) -> bool:
+        result = await self.db.execute(
+            delete(User).where(User.id == user_id, User.is_verified == True).returning(User.email)
+        )
+        email = result.scalar_one_or_none()
+        await self.db.commit()
+        if email is None:
+            return False
+
+        await _written(email, user_id, writer)
+        evict_tokens(email)
+        return True
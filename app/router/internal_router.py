@@ -0,0 +1,27 @@
+from fastapi import APIRouter, Depends, status
+from fastapi.responses import JSONResponse
+from app.utils import readiness
+from app.config.database import engine, async_engine
+from app.utils.pool_stats import pool_status
+from app.dependency import internal_access
+
+router = APIRouter(
+    prefix='/internal',
+    tags = ["Internal"],
+    include_in_schema=False,
+)
+
+
+@router.get('/db-pool', status_code=status.HTTP_200_OK, dependencies=[Depends(internal_access)])
+async def db_pool_status() -> dict:
+    return {
+        'async': pool_status(async_engine.sync_engine),
+        'sync': pool_status(engine),
+    }
+
+
+@router.get('/ready', status_code=status.HTTP_200_OK)
+async def ready() -> JSONResponse:
+    if readiness.is_ready():
+        return JSONResponse({'status': 'ready'})
+    return JSONResponse({'status': 'warming up'}, status_code=status.HTTP_503_SERVICE_UNAVAILABLE)
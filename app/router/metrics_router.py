@@ -0,0 +1,13 @@
+from fastapi import APIRouter, Depends, Response
+from app.utils.metrics import registry, CONTENT_TYPE
+from app.dependency import internal_access
+
+router = APIRouter(
+    tags = ["Internal"],
+    include_in_schema=False,
+)
+
+
+@router.get('/metrics', dependencies=[Depends(internal_access)])
+async def metrics() -> Response:
+    return Response(registry.render(), media_type=CONTENT_TYPE)
@@ -1,16 +1,22 @@
-from fastapi import APIRouter, Depends, status, BackgroundTasks, HTTPException, Body, Request, Form
+from fastapi import APIRouter, Depends, status, BackgroundTasks, HTTPException, Body, Request, Form, Query, Header
 from pydantic import EmailStr
 from fastapi.security import OAuth2PasswordRequestForm
-from app.schemas.request_schemas import UserInput, UserUpdate
-from app.schemas.response_schemas import UserOutput, Token
+from app.schemas.request_schemas import UserInput, UserUpdate, RefreshTokenInput
+from app.schemas.response_schemas import UserOutput, UserPage, UserBatch, SearchPage, ImportReport, Token
 from app.service.user_service import UserService
-from typing import Annotated
-from app.config.database import get_db
-from sqlalchemy.orm import Session
-from app.dependency import get_current_user
-from datetime import timedelta
-from app.security.jwt_token import create_access_token
+from typing import Annotated, Literal
+from app.config.database import get_db, get_sessionmaker
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.dependency import get_current_user, READ_DATABASE_OBJECT
 from fastapi.templating import Jinja2Templates
+from fastapi.responses import StreamingResponse, Response
+from sqlalchemy.ext.asyncio import async_sessionmaker
+from app.utils.query_stats import query_budget
+from app.utils.serializers import json_response, principal_dict
+from app.utils.etag import make_etag, etag_matches
+from app.security.rate_limit import admission, form_username, json_email, token_subject
+from app.utils.activity import activity
+from settings import settings
 
 templates = Jinja2Templates(directory="templates")
 
@@ -20,96 +26,190 @@ router = APIRouter(
     responses={404:{'detail' : 'endpoint not found'}}
 )
 
-DATABASE_OBJECT = Annotated[Session, Depends(get_db)]
+DATABASE_OBJECT = Annotated[AsyncSession, Depends(get_db)]
+IF_NONE_MATCH = Annotated[str | None, Header(include_in_schema=False)]
+
+# clients may keep profiles but must revalidate them with If-None-Match
+PROFILE_CACHE_CONTROL = 'private, no-cache'
+
+
+def profile_response(payload: dict | bytes | None, etag: str) -> Response:
+    headers = {'ETag': etag, 'Cache-Control': PROFILE_CACHE_CONTROL}
+    if payload is None:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    if isinstance(payload, bytes):
+        return Response(payload, media_type='application/json', headers=headers)       # already serialized (response cache)
+    return json_response(payload, headers=headers)
+
+
+def principal_response(user: UserOutput, if_none_match: str | None) -> Response:
+    etag = make_etag(user.id, user.updated_at, 'self')
+    return profile_response(None if etag_matches(if_none_match, etag) else principal_dict(user), etag)
 
 @router.get('/send-template', include_in_schema=False)
-def template_response(request: Request, token: str, data: str):
+async def template_response(request: Request, token: str, data: str):
     return templates.TemplateResponse(
         request=request, name="change_password.html", context={"token":token, "data":data}
     )
 
 
-@router.post('/', status_code=status.HTTP_201_CREATED)
-def create_user(user: UserInput, background_task: BackgroundTasks, db: DATABASE_OBJECT) -> dict:
-    _service = UserService(db, background_task)
-    return _service.create(user)
+@router.post('/', status_code=status.HTTP_201_CREATED, dependencies=[Depends(query_budget(3)), Depends(admission('signup', json_email))])
+async def create_user(user: UserInput, db: DATABASE_OBJECT) -> dict:
+    _service = UserService(db)
+    return await _service.create(user)
 
 
-@router.get('/verify', status_code=status.HTTP_200_OK)
-def verify_account(token: str, data: str, db: DATABASE_OBJECT) -> dict:
+@router.get('/verify', status_code=status.HTTP_200_OK, dependencies=[Depends(query_budget(2))])
+async def verify_account(token: str, data: str, db: DATABASE_OBJECT) -> dict:
     _service = UserService(db)
-    return _service.verify_account(token, data)
+    return await _service.verify_account(token, data)
 
 
-@router.get('/me', response_model=UserOutput, response_model_exclude_none = True, status_code=status.HTTP_200_OK)
-def my_profile(user: Annotated[UserOutput, Depends(get_current_user)]):
-    return user
+@router.get('/me', response_model=UserOutput, response_model_exclude_none = True, status_code=status.HTTP_200_OK, dependencies=[Depends(query_budget(1))])
+async def my_profile(user: Annotated[UserOutput, Depends(get_current_user)], if_none_match: IF_NONE_MATCH = None):
+    return principal_response(user, if_none_match)
 
 
-@router.get('/all', response_model=list[UserOutput], response_model_exclude_none = True, status_code=status.HTTP_200_OK)
-def all_users(user: Annotated[UserOutput, Depends(get_current_user)], db: DATABASE_OBJECT):
+@router.get('/all', response_model=UserPage, status_code=status.HTTP_200_OK, dependencies=[Depends(query_budget(2))])
+async def all_users(
+    user: Annotated[UserOutput, Depends(get_current_user)],
+    db: READ_DATABASE_OBJECT,
+    limit: Annotated[int, Query(ge=1, le=settings.PAGE_MAX_LIMIT)] = settings.PAGE_DEFAULT_LIMIT,
+    cursor: Annotated[int | None, Query(description='next_cursor of the previous page')] = None,
+    fields: Annotated[str | None, Query(description='comma separated fields to return, e.g. email,fullname')] = None,
+):
     super_user = True if user.is_superuser else False
     _service = UserService(db)
-    users = _service.get_all_users(user.id, super_user)
-    users.append(user)
-    return users
+    return Response(await _service.get_all_users_body(super_user, limit, cursor, fields), media_type='application/json')
+
+
+EXPORT_MEDIA_TYPES = {'ndjson': 'application/x-ndjson', 'csv': 'text/csv'}
+
+@router.get('/export', status_code=status.HTTP_200_OK, dependencies=[Depends(query_budget(2))])
+async def export_users(
+    user: Annotated[UserOutput, Depends(get_current_user)],
+    session_factory: Annotated[async_sessionmaker, Depends(get_sessionmaker)],
+    format: Literal['ndjson', 'csv'] = 'ndjson',
+):
+    if not user.is_superuser:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail='Permission Denied')
+    return StreamingResponse(
+        UserService.export_users(session_factory, format),
+        media_type=EXPORT_MEDIA_TYPES[format],
+        headers={'Content-Disposition': f'attachment; filename=users.{format}'},
+    )
+
 
+@router.post(
+    '/import',
+    status_code=status.HTTP_200_OK,
+    summary='Bulk import users',
+    description='Superuser only. Upload JSON lines (application/x-ndjson) or CSV with a header row (text/csv), every row is reported back.',
+    openapi_extra={'requestBody': {'content': {'application/x-ndjson': {'schema': {'type': 'string'}}, 'text/csv': {'schema': {'type': 'string'}}}, 'required': True}},
+)
+async def import_users(request: Request, user: Annotated[UserOutput, Depends(get_current_user)], db: DATABASE_OBJECT, verified: bool = True) -> ImportReport:
+    if not user.is_superuser:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail='Permission Denied')
+    _service = UserService(db)
+    return await _service.import_users(await request.body(), request.headers.get('content-type', ''), verified, user.email)
 
-@router.get('/{user_id}', response_model=UserOutput, response_model_exclude_none = True, status_code=status.HTTP_200_OK)
-def user_profile(user_id: int, user: Annotated[UserOutput, Depends(get_current_user)], db: DATABASE_OBJECT):
+
+@router.get('/batch', response_model=UserBatch, status_code=status.HTTP_200_OK, dependencies=[Depends(query_budget(2))])
+async def users_batch(
+    user: Annotated[UserOutput, Depends(get_current_user)],
+    db: READ_DATABASE_OBJECT,
+    ids: Annotated[str, Query(description='comma separated user ids, items come back in the same order', examples=['1,2,3'])],
+):
+    super_user = True if user.is_superuser else False
+    _service = UserService(db)
+    batch = await _service.get_users_by_ids(super_user, ids)
+    return json_response({'items': batch.items, 'missing': batch.missing})
+
+
+@router.get('/search', response_model=SearchPage, status_code=status.HTTP_200_OK, dependencies=[Depends(query_budget(2))])
+async def search_users(
+    user: Annotated[UserOutput, Depends(get_current_user)],
+    db: READ_DATABASE_OBJECT,
+    q: Annotated[str, Query(min_length=1, max_length=200, description='words matched as prefixes of name, email and bio')],
+    limit: Annotated[int, Query(ge=1, le=settings.PAGE_MAX_LIMIT)] = settings.PAGE_DEFAULT_LIMIT,
+    cursor: Annotated[str | None, Query(description='next_cursor of the previous page')] = None,
+):
+    super_user = True if user.is_superuser else False
+    _service = UserService(db)
+    page = await _service.search_users(super_user, q, limit, cursor)
+    return json_response({'items': page.items, 'next_cursor': page.next_cursor})
+
+
+@router.get('/{user_id}', response_model=UserOutput, response_model_exclude_none = True, status_code=status.HTTP_200_OK, dependencies=[Depends(query_budget(3))])
+async def user_profile(user_id: int, user: Annotated[UserOutput, Depends(get_current_user)], db: READ_DATABASE_OBJECT, if_none_match: IF_NONE_MATCH = None):
     if user_id == user.id:
-        return user
+        return principal_response(user, if_none_match)
     super_user = True if user.is_superuser else False
     _service = UserService(db)
-    return _service.get_user_by_id(user_id, super_user)
+    return profile_response(*await _service.get_user_by_id(user_id, super_user, if_none_match))
 
 
 
-@router.post("/login", summary='Login User', description="Login user to get access token")
-def login_for_access_token(form_data: Annotated[OAuth2PasswordRequestForm, Depends()], db: DATABASE_OBJECT) -> Token:
-    _service = UserService(db)
-    user = _service.authenticate_user(form_data.username, form_data.password)
+@router.post("/login", summary='Login User', description="Login user to get access and refresh tokens", dependencies=[Depends(query_budget(2)), Depends(admission('login', form_username))])
+async def login_for_access_token(
+    request: Request,
+    form_data: Annotated[OAuth2PasswordRequestForm, Depends()],
+    background_task: BackgroundTasks,
+    db: DATABASE_OBJECT,
+    session_factory: Annotated[async_sessionmaker, Depends(get_sessionmaker)],
+) -> Token:
+    _service = UserService(db, background_task)
+    user = await _service.authenticate_user(form_data.username, form_data.password, session_factory)
+    activity.login(
+        user.id if user else None,
+        form_data.username,
+        bool(user),
+        request.client.host if request.client else None,
+        request.headers.get('user-agent'),
+    )
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect email or password",
             headers={"WWW-Authenticate": "Bearer"},
         )
-    access_token_expires = timedelta(minutes=60)
-    access_token = create_access_token(
-        data={"sub": user.email}, expires_delta=access_token_expires
-    )
-    return Token(access_token=access_token, token_type="bearer")
+    return await _service.issue_tokens(user.id, user.email)
+
+
+@router.post("/token/refresh", summary='Refresh Token', description="Exchange a refresh token for a new access and refresh token, without the password", dependencies=[Depends(query_budget(3)), Depends(admission('token-refresh'))])
+async def refresh_access_token(data: RefreshTokenInput, db: DATABASE_OBJECT) -> Token:
+    _service = UserService(db)
+    return await _service.refresh_access_token(data.refresh_token)
 
 
-@router.patch("/", status_code=status.HTTP_204_NO_CONTENT)
-def update_profile(data: UserUpdate, user: Annotated[UserOutput, Depends(get_current_user)], db: DATABASE_OBJECT):
+@router.patch("/", status_code=status.HTTP_204_NO_CONTENT, dependencies=[Depends(query_budget(2))])
+async def update_profile(data: UserUpdate, user: Annotated[UserOutput, Depends(get_current_user)], db: DATABASE_OBJECT):
     _service = UserService(db)
-    return _service.update_data(user.email, data)
+    return await _service.update_data(user.email, data)
 
 
-@router.delete("/{user_id}", status_code=status.HTTP_204_NO_CONTENT)
-def delete_user(user_id: int, user: Annotated[UserOutput, Depends(get_current_user)], db: DATABASE_OBJECT):
+@router.delete("/{user_id}", status_code=status.HTTP_204_NO_CONTENT, dependencies=[Depends(query_budget(2))])
+async def delete_user(user_id: int, user: Annotated[UserOutput, Depends(get_current_user)], db: DATABASE_OBJECT):
     has_permission = True if user.is_superuser or user_id == user.id else False
     _service = UserService(db)
-    return _service.delete_user(user_id, has_permission)
+    return await _service.delete_user(user_id, has_permission, user.email)
 
-@router.post("/forgot-password")
-def forgot_password(email: Annotated[EmailStr, Body(examples=['chauashish21@gmail.com'])], background_task: BackgroundTasks, db: DATABASE_OBJECT) -> dict:
-    _service = UserService(db, background_task)
-    return _service.forgot_password_service(email)
+@router.post("/forgot-password", dependencies=[Depends(query_budget(2)), Depends(admission('forgot-password', json_email))])
+async def forgot_password(email: Annotated[EmailStr, Body(examples=['chauashish21@gmail.com'])], db: DATABASE_OBJECT) -> dict:
+    _service = UserService(db)
+    return await _service.forgot_password_service(email)
 
 
-@router.post("/reset-forgot-password", include_in_schema=False)
-def reset_forgotted_password(token: Annotated[str, Form()], data: Annotated[str, Form()], new_password: Annotated[str, Form()], db: DATABASE_OBJECT) -> dict:
+@router.post("/reset-forgot-password", include_in_schema=False, dependencies=[Depends(query_budget(3)), Depends(admission('reset-forgot-password'))])
+async def reset_forgotted_password(token: Annotated[str, Form()], data: Annotated[str, Form()], new_password: Annotated[str, Form()], db: DATABASE_OBJECT) -> dict:
     _service = UserService(db)
-    return _service.verify_and_reset_password(token, data, new_password)
+    return await _service.verify_and_reset_password(token, data, new_password)
 
 
-@router.post("/reset-password")
-def reset_password(password: Annotated[str, Body(examples=['Refd14565@sd'])], user: Annotated[UserOutput, Depends(get_current_user)], db: DATABASE_OBJECT) -> dict:
+@router.post("/reset-password", dependencies=[Depends(query_budget(3)), Depends(admission('reset-password', token_subject))])
+async def reset_password(password: Annotated[str, Body(examples=['Refd14565@sd'])], user: Annotated[UserOutput, Depends(get_current_user)], db: DATABASE_OBJECT) -> dict:
     _service = UserService(db)
-    return _service.reset_password(user.email, password)
+    return await _service.reset_password(user.email, password)
 
 
 
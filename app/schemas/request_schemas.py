@@ -35,3 +35,5 @@ class UserUpdate(BaseModel):
     last_name: str | None = None
     bio: str | None = None
 
+class RefreshTokenInput(BaseModel):
+    refresh_token: str
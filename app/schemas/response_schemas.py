@@ -1,5 +1,6 @@
-from pydantic import BaseModel, EmailStr, computed_field
+from pydantic import BaseModel, EmailStr, computed_field, Field
 from datetime import datetime
+from typing import Any
 
 class UserOutput(BaseModel):
     id: int | None = None
@@ -9,6 +10,7 @@ class UserOutput(BaseModel):
     is_superuser: bool | None = None
     bio: str | None = None
     created_at: datetime | None = None
+    updated_at: datetime | None = Field(default=None, exclude=True)      # only used to build the ETag
     
 
     @computed_field
@@ -16,9 +18,33 @@ class UserOutput(BaseModel):
     def fullname(self) -> str:
         return f'{self.first_name} {self.last_name}'
     
+class UserPage(BaseModel):
+    items: list[dict[str, Any]]
+    next_cursor: int | None = None
+
+class UserBatch(BaseModel):
+    items: list[dict[str, Any] | None]          # aligned with the requested ids, null for a miss
+    missing: list[int]
+
+class SearchPage(BaseModel):
+    items: list[dict[str, Any]]
+    next_cursor: str | None = None
+
+class ImportRowResult(BaseModel):
+    row: int
+    email: str | None = None
+    status: str                     # created, duplicate, invalid or error
+    detail: str | None = None
+
+class ImportReport(BaseModel):
+    created: int
+    failed: int
+    results: list[ImportRowResult]
+
 class Token(BaseModel):
     access_token: str
     token_type: str
+    refresh_token: str | None = None
 
 class TokenData(BaseModel):
     user_email: str
@@ -1,18 +1,140 @@
-from passlib.context import CryptContext
+import asyncio
+import functools
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from app.utils import metrics
+from settings import settings
 
-pwd_context = CryptContext(schemes=['bcrypt'], deprecated = 'auto')
+
+@functools.cache
+def pwd_context():
+    '''The first of PASSWORD_SCHEMES hashes new passwords, hashes in other schemes or with other costs need an update'''
+
+    from passlib.context import CryptContext                # imported on first use, keeps it off the startup path
+    options = {
+        # pinning min and max to the default makes needs_update flag hashes of any other cost, cheaper or dearer
+        'bcrypt__default_rounds': settings.BCRYPT_ROUNDS,
+        'bcrypt__min_rounds': settings.BCRYPT_ROUNDS,
+        'bcrypt__max_rounds': settings.BCRYPT_ROUNDS,
+    }
+    if 'argon2' in settings.PASSWORD_SCHEMES:
+        options.update({
+            'argon2__time_cost': settings.ARGON2_TIME_COST,
+            'argon2__memory_cost': settings.ARGON2_MEMORY_COST,
+            'argon2__parallelism': settings.ARGON2_PARALLELISM,
+        })
+    return CryptContext(schemes=settings.PASSWORD_SCHEMES, deprecated = 'auto', **options)
 
 def hash_password(password: str) -> str:
-    return pwd_context.hash(password)
+    return pwd_context().hash(password)
 
 
 def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return pwd_context.verify(plain_password, hashed_password)
+    return pwd_context().verify(plain_password, hashed_password)
+
+
+def hash_passwords(passwords: list[str]) -> list[str]:
+    return [pwd_context().hash(password) for password in passwords]
+
+
+def needs_update(hashed_password: str) -> bool:
+    '''True when the hash uses another scheme or cost than the settings, cheap enough for the event loop'''
+
+    return pwd_context().needs_update(hashed_password)
+
+
+def _warm_up() -> None:
+    handler = pwd_context().handler()
+    (handler.using(rounds=4) if handler.name == 'bcrypt' else handler).hash('warm-up')    # loads the backend at minimum cost
+
+
+# bcrypt is CPU bound, so the async API runs it on a dedicated process pool instead of the request threadpool
+
+class HashingBusy(Exception):
+    '''Raised when more hashing jobs are in flight than the pool size plus queue depth allows'''
+
+
+_executor: ProcessPoolExecutor | None = None
+_lock = threading.Lock()
+_in_flight = 0
+
+
+def get_executor() -> ProcessPoolExecutor:
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(
+                max_workers=settings.HASHING_POOL_SIZE,
+                mp_context=multiprocessing.get_context('spawn'),   # forking a threaded server is unsafe
+            )
+        return _executor
+
+
+def shutdown_executor() -> None:
+    global _executor
+    with _lock:
+        executor, _executor = _executor, None
+    if executor is not None:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+async def warm_up() -> None:
+    '''Start every pool process and load bcrypt in it, so the first logins do not pay for the spawn'''
+
+    loop = asyncio.get_running_loop()
+    executor = get_executor()
+    await asyncio.gather(*(loop.run_in_executor(executor, _warm_up) for _ in range(settings.HASHING_POOL_SIZE)))
+
+
+def _capacity() -> int:
+    return settings.HASHING_POOL_SIZE + settings.HASHING_QUEUE_DEPTH
+
+
+def saturated() -> bool:
+    '''True when a new hashing job would be rejected, lets callers shed load before doing other work'''
+
+    return _in_flight >= _capacity()
+
+
+async def _run_in_pool(func, *args):
+    global _in_flight
+    with _lock:
+        if _in_flight >= _capacity():
+            raise HashingBusy()
+        _in_flight += 1
+    try:
+        loop = asyncio.get_running_loop()
+        with metrics.hashing_duration.time(operation=func.__name__):
+            return await loop.run_in_executor(get_executor(), func, *args)
+    finally:
+        with _lock:
+            _in_flight -= 1
+
+
+async def hash_password_async(password: str) -> str:
+    return await _run_in_pool(hash_password, password)
+
+
+async def verify_password_async(plain_password: str, hashed_password: str) -> bool:
+    return await _run_in_pool(verify_password, plain_password, hashed_password)
+
+
+async def hash_passwords_async(passwords: list[str]) -> list[str]:
+    '''Hash many passwords in small chunks on at most HASHING_BATCH_WORKERS pool processes at a time.
 
+    At least one process stays free for logins, only a pool of a single process is shared with them,
+    and a login queued behind a chunk waits for one chunk only.
+    '''
 
+    if not passwords:
+        return []
+    size = settings.HASHING_BATCH_CHUNK
+    slots = asyncio.Semaphore(max(1, min(settings.HASHING_BATCH_WORKERS, settings.HASHING_POOL_SIZE - 1)))
 
-def hash_data(data: str) -> str:
-    return pwd_context.hash(data)
+    async def run(chunk: list[str]) -> list[str]:
+        async with slots:
+            return await _run_in_pool(hash_passwords, chunk)
 
-def verify_data(raw_data: str, hashed_data: str) -> bool:
-    return pwd_context.verify(raw_data, hashed_data)
\ No newline at end of file
+    results = await asyncio.gather(*(run(passwords[i:i + size]) for i in range(0, len(passwords), size)))
+    return [hashed for chunk in results for hashed in chunk]
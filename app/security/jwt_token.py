@@ -1,10 +1,14 @@
+import hashlib
 import os
+import secrets
+import time
 import jwt
 from jwt.exceptions import InvalidTokenError
 from dotenv import load_dotenv
 from datetime import datetime, timedelta, timezone
 from fastapi import HTTPException, status
 from app.schemas.response_schemas import TokenData
+from app.utils.cache import token_cache
 
 load_dotenv()
 
@@ -25,6 +29,15 @@ def create_access_token(data: dict, expires_delta: timedelta | None = None):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
+def create_refresh_token() -> tuple[str, str]:
+    '''An opaque random refresh token and the digest it is stored under'''
+
+    token = secrets.token_urlsafe(32)
+    return token, refresh_token_digest(token)
+
+def refresh_token_digest(token: str) -> str:
+    return hashlib.sha256(token.encode()).hexdigest()
+
 def decode_access_token(token: str) -> TokenData | HTTPException:
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
@@ -32,11 +45,27 @@ def decode_access_token(token: str) -> TokenData | HTTPException:
         headers={"WWW-Authenticate": "Bearer"},
     )
 
+    token_data = token_cache.get(token)
+    if token_data is not None:
+        return token_data                       # signature already verified and not expired yet
+
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM], options={'require': ['exp']})   # exp also bounds the cache entry
         user_email = payload.get("sub")
         if user_email is None:
             raise credentials_exception
-        return TokenData(user_email=user_email)
     except InvalidTokenError:
-        raise credentials_exception
\ No newline at end of file
+        raise credentials_exception
+
+    token_data = TokenData(user_email=user_email)
+    token_cache.set(token, token_data, ttl=payload['exp'] - time.time())
+    return token_data
+
+
+def evict_tokens(user_email: str) -> int:
+    '''Forget the verified tokens of `user_email` so their next use is decoded (and checked) again.
+
+    Called on password changes and account deletion, and the place to hook token revocation into.
+    '''
+
+    return token_cache.invalidate_where(lambda _, token_data: token_data.user_email == user_email)
\ No newline at end of file
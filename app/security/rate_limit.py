@@ -0,0 +1,171 @@
+import asyncio
+import importlib
+import logging
+import math
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Awaitable, Callable
+from fastapi import HTTPException, Request, status
+from fastapi.concurrency import run_in_threadpool
+from app.security import hashing
+from app.security.jwt_token import decode_access_token
+from settings import settings
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimitStore(ABC):
+    '''Token bucket storage, implement `hit` to share the limits between workers'''
+
+    @abstractmethod
+    def hit(self, key: str, rate: float, capacity: float) -> float:
+        '''Take one token from bucket `key` (refilled at `rate` per second), return 0 or the seconds until one is available'''
+
+
+def _take(tokens: float, last: float, now: float, rate: float, capacity: float) -> tuple[float, float]:
+    tokens = min(capacity, tokens + (now - last) * rate)
+    if tokens >= 1:
+        return tokens - 1, 0.0
+    return tokens, (1 - tokens) / rate
+
+
+class MemoryRateLimitStore(RateLimitStore):
+    '''Per process buckets, the least recently used keys are dropped beyond `max_keys`'''
+
+    def __init__(self, max_keys: int = 100_000):
+        self.max_keys = max_keys
+        self._buckets: OrderedDict[str, tuple[float, float]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def hit(self, key: str, rate: float, capacity: float) -> float:
+        now = time.monotonic()
+        with self._lock:
+            tokens, last = self._buckets.get(key, (capacity, now))
+            tokens, retry_after = _take(tokens, last, now, rate, capacity)
+            self._buckets[key] = (tokens, now)
+            self._buckets.move_to_end(key)
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return retry_after
+
+
+class SQLiteRateLimitStore(RateLimitStore):
+    '''Buckets in a SQLite file (on tmpfs when available) shared by every worker on the host.
+
+    Each row records when its bucket is full again, a full bucket is the same as a missing one so
+    every PRUNE_EVERY hits those rows are deleted.
+    '''
+
+    PRUNE_EVERY = 1000
+
+    def __init__(self, path: str | None = None):
+        shm = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+        self.path = path or os.path.join(shm, 'profilely-rate-limit.sqlite')
+        self._local = threading.local()
+        self._hits = 0
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=settings.RATE_LIMIT_STORE_TIMEOUT, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('CREATE TABLE IF NOT EXISTS token_buckets (key TEXT PRIMARY KEY, tokens REAL, updated REAL, full_at REAL)')
+            connection.execute('CREATE INDEX IF NOT EXISTS token_buckets_full_at ON token_buckets (full_at)')
+            self._local.connection = connection
+        return connection
+
+    def hit(self, key: str, rate: float, capacity: float) -> float:
+        now = time.time()
+        connection = self._connection()
+        self._hits += 1
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            row = connection.execute('SELECT tokens, updated FROM token_buckets WHERE key = ?', (key,)).fetchone()
+            tokens, retry_after = _take(*(row or (capacity, now)), now, rate, capacity)
+            connection.execute(
+                'INSERT OR REPLACE INTO token_buckets (key, tokens, updated, full_at) VALUES (?, ?, ?, ?)',
+                (key, tokens, now, now + (capacity - tokens) / rate),
+            )
+            if self._hits % self.PRUNE_EVERY == 0:
+                connection.execute('DELETE FROM token_buckets WHERE full_at <= ?', (now,))
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        return retry_after
+
+
+def load_store(path: str) -> RateLimitStore:
+    module_name, class_name = path.rsplit('.', 1)
+    return getattr(importlib.import_module(module_name), class_name)()
+
+
+store = load_store(settings.RATE_LIMIT_STORE)
+
+
+async def _hit(key: str, rate: float, capacity: float) -> float:
+    '''`store.hit` off the event loop, a store that fails or answers too slowly lets the request through'''
+
+    try:
+        return await asyncio.wait_for(run_in_threadpool(store.hit, key, rate, capacity), settings.RATE_LIMIT_STORE_TIMEOUT)
+    except Exception as e:
+        logger.warning('rate limit store unavailable, admitting %s: %r', key, e)
+        return 0.0
+
+
+async def enforce(scope: str, request: Request, account: str | None = None) -> None:
+    '''Admission check for expensive auth endpoints, meant to run before any hashing or database work.
+
+    Sheds the request with 429 when the client IP or the targeted account is over its token bucket,
+    and with 503 when the hashing pool is already saturated.
+    '''
+
+    buckets = [(f'{scope}:ip:{request.client.host if request.client else "unknown"}', settings.RATE_LIMIT_IP_PER_MINUTE)]
+    if account:
+        buckets.append((f'{scope}:account:{account.lower()}', settings.RATE_LIMIT_ACCOUNT_PER_MINUTE))
+
+    for key, per_minute in buckets:
+        retry_after = await _hit(key, per_minute / 60, settings.RATE_LIMIT_BURST)
+        if retry_after:
+            raise HTTPException(
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                detail='too many requests, please retry later',
+                headers={'Retry-After': str(math.ceil(retry_after))},
+            )
+
+    if hashing.saturated():
+        raise hashing.HashingBusy()
+
+
+def admission(scope: str, account: Callable[[Request], Awaitable[str | None]] | None = None):
+    '''Route dependency running `enforce`, route level dependencies are solved before the endpoint's own'''
+
+    async def _admit(request: Request) -> None:
+        await enforce(scope, request, await account(request) if account else None)
+    return _admit
+
+
+# account extractors, the body has already been parsed and cached on the request by FastAPI
+
+async def form_username(request: Request) -> str | None:
+    return (await request.form()).get('username')
+
+
+async def json_email(request: Request) -> str | None:
+    try:
+        body = await request.json()
+    except ValueError:
+        return None
+    return body.get('email') if isinstance(body, dict) else body if isinstance(body, str) else None
+
+
+async def token_subject(request: Request) -> str | None:
+    scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+    if scheme.lower() != 'bearer' or not token:
+        return None
+    return decode_access_token(token).user_email
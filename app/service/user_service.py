@@ -1,123 +1,383 @@
 from fastapi import HTTPException, status, BackgroundTasks
-from sqlalchemy.orm import Session
-from app.repository.user_repository import UserRepository
+from pydantic import ValidationError
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+from typing import AsyncIterator
+import base64
+import csv
+import io
+import json
+import re
+import orjson
+import uuid
+from datetime import datetime, timedelta
+from app.repository.user_repository import UserRepository, PUBLIC_FIELDS, SUPERUSER_FIELDS
+from app.repository.refresh_token_repository import RefreshTokenRepository
 from app.schemas.request_schemas import UserInput, UserUpdate
-from app.schemas.response_schemas import UserOutput
-from app.utils.email_util import send_email_background
-from app.security import hashing, encode_decode
+from app.schemas.response_schemas import UserOutput, UserPage, UserBatch, SearchPage, ImportReport, ImportRowResult, Token
+from app.repository.job_repository import JobRepository
+from app.utils.job_queue import SEND_LINK, link_job
+from app.security import hashing, encode_decode, signed_token, jwt_token
+from settings import settings
+from app.utils.cache import principal_cache
+from app.utils.serializers import user_dict
+from app.utils.etag import make_etag, etag_matches
+from app.utils.response_cache import response_cache
 
 
 
+def _parse_import(body: bytes, content_type: str) -> list[dict | str]:
+    '''Rows of a CSV (with header) or JSON lines upload, unparsable lines are kept as error strings'''
+
+    try:
+        text = body.decode('utf-8-sig')
+    except UnicodeDecodeError as e:
+        return [f'upload is not valid UTF-8 (byte {e.start})']
+    if 'csv' in content_type:
+        return [
+            'more fields than the header' if None in row else {key: value for key, value in row.items() if value not in ('', None)}
+            for row in csv.DictReader(io.StringIO(text))
+        ]
+
+    rows = []
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+            rows.append(row if isinstance(row, dict) else 'expected a JSON object')
+        except json.JSONDecodeError as e:
+            rows.append(f'invalid JSON: {e.msg}')
+    return rows
+
+
+def _search_cursor(score: float, user_id: int) -> str:
+    return base64.urlsafe_b64encode(f'{score!r}:{user_id}'.encode()).decode()
+
+
+def _read_search_cursor(cursor: str) -> tuple[float, int]:
+    try:
+        score, user_id = base64.urlsafe_b64decode(cursor.encode()).decode().split(':')
+        return float(score), int(user_id)
+    except ValueError:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='invalid cursor')
+
+
+async def rehash_password(session_factory: async_sessionmaker, email: str, password: str, old_hash: str) -> None:
+    new_hash = await hashing.hash_password_async(password)
+    async with session_factory() as db:
+        await UserRepository(db).replace_password_hash(email, old_hash, new_hash)
+
+
 class UserService:
 
-    def __init__(self, db: Session, background_task:BackgroundTasks = None):
+    def __init__(self, db: AsyncSession, background_task:BackgroundTasks = None):
+        self.db = db
         self.background_task = background_task
         self.repository = UserRepository(db)
+        self.token_repository = RefreshTokenRepository(db)
+        self.job_repository = JobRepository(db)
 
 
-    def create(self, user: UserInput) -> dict | HTTPException:
-        if self.repository.user_exist_with_email(user.email):
+    async def create(self, user: UserInput) -> dict | HTTPException:
+        if await self.repository.user_exist_with_email(user.email):
             raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='user with same email already registered')
         
-        user.password = hashing.hash_password(user.password)        # hashing the password before creating instance
-        user_instance, db_exception = self.repository.create(user)
+        user.password = await hashing.hash_password_async(user.password)        # hashing the password before creating instance
+        await self.job_repository.enqueue(                          # verify mail, committed together with the user (outbox)
+            SEND_LINK,
+            link_job(user.email, signed_token.VERIFY_ACCOUNT),
+            settings.JOB_MAX_ATTEMPTS,
+            dedup_key=f'verify-email:{user.email}',
+            commit=False,
+            )
+        user_instance, db_exception = await self.repository.create(user)
 
         if user_instance:
-            token = hashing.hash_data(user_instance.get_context())
-            identity = encode_decode.encode_data(user_instance.email)
-
-            self.background_task.add_task(                          # sending email verify mail to the registered user
-                send_email_background,
-                'Account Verification',
-                user_instance.email,
-                'verify_email_template.html',
-                {'token': token, 'data': identity}
-                )
-            
             # return user_instance
             return {'success' : 'profile created, a verification link has been send to your registered email'}
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f'{db_exception}')
         
 
-    def verify_account(self, token, data) -> dict | HTTPException:
-        email = encode_decode.decode_data(data.strip()).strip()
-        if not self.repository.user_exist_with_email(email):
+    async def verify_account(self, token, data) -> dict | HTTPException:
+        payload = self._read_link(token, data, signed_token.VERIFY_ACCOUNT)
+        user_instance = await self.repository.get_user_by_email(payload['sub'], False)
+        if user_instance is None:
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='user not found')
-        
-        user_context = self.repository.get_user_context(email)
 
-        try:
-            if hashing.verify_data(user_context, token):
-                return self.repository.verify_profile(email)
-            else:
-                raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="link has expired or invalid")
-        except:
-            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='link has expired or invalid')
+        self._check_link_version(payload, user_instance)
+        return await self.repository.verify_profile(user_instance)
         
 
-    def get_current_user(self, email: str):
-        if not self.repository.user_exist(email):
-            return None
-        
-        return self.repository.get_current_user(email)
+    async def get_current_user(self, email: str):
+        # the shared generation is bumped by writes on any worker, it is read before the query
+        generation = await response_cache.generation(f'principal:{email}')
+        cached = principal_cache.get(email)
+        if cached is not None and generation is not None and cached[0] == generation:
+            return cached[1]
+
+        user = await self.repository.get_current_user(email)
+        if user is not None and generation is not None:
+            principal_cache.set(email, (generation, user))
+        return user
     
-    def authenticate_user(self, email: str, password: str):
-        return self.repository.authenticate_user(email, password)
+    async def authenticate_user(self, email: str, password: str, session_factory: async_sessionmaker | None = None):
+        user_instance = await self.repository.get_user_by_email(email)
+        if not user_instance:
+            return False
+        if not await hashing.verify_password_async(password, user_instance.password):
+            return False
+        if session_factory is not None and self.background_task is not None and hashing.needs_update(user_instance.password):
+            # the plain password is only available now, rehash under the current policy after the response is sent
+            self.background_task.add_task(rehash_password, session_factory, user_instance.email, password, user_instance.password)
+        return user_instance
+
+    async def issue_tokens(self, user_id: int, email: str, family: str | None = None) -> Token:
+        '''Short lived access token plus a refresh token, rotations keep the `family` of the original login'''
+
+        access_token = jwt_token.create_access_token(
+            data={'sub': email}, expires_delta=timedelta(minutes=jwt_token.ACCESS_TOKEN_EXPIRE_MINUTES)
+        )
+        refresh_token, token_hash = jwt_token.create_refresh_token()
+        await self.token_repository.create(
+            user_id,
+            token_hash,
+            family or uuid.uuid4().hex,
+            datetime.now() + timedelta(minutes=jwt_token.REFRESH_TOKEN_EXPIRE_MINUTES),
+        )
+        return Token(access_token=access_token, refresh_token=refresh_token, token_type='bearer')
+
+    async def refresh_access_token(self, refresh_token: str) -> Token:
+        credentials_exception = HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail='refresh token has expired or invalid',
+            headers={'WWW-Authenticate': 'Bearer'},
+        )
+        token_hash = jwt_token.refresh_token_digest(refresh_token)
+        consumed = await self.token_repository.consume(token_hash)
+        if consumed is None:
+            # presenting a token that was already rotated means it leaked, end that whole login
+            await self.token_repository.revoke_family_of(token_hash)
+            raise credentials_exception
+
+        user_id, family = consumed
+        email = await self.repository.get_email(user_id)
+        if email is None:
+            raise credentials_exception
+        return await self.issue_tokens(user_id, email, family)
     
-    def get_all_users(self, exclude_id: int, super_user: bool):
-        return self.repository.all_users(exclude_id, super_user)
+    async def get_all_users(self, super_user: bool, limit: int, cursor: int | None = None, fields: str | None = None) -> UserPage:
+        visible = SUPERUSER_FIELDS if super_user else PUBLIC_FIELDS
+        requested = [field.strip() for field in fields.split(',') if field.strip()] if fields else [*visible, 'fullname']
+        unknown = set(requested) - {*visible, 'fullname'}
+        if unknown:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f'unknown fields: {", ".join(sorted(unknown))}')
+
+        columns = [field for field in visible if field in requested or (field in ('first_name', 'last_name') and 'fullname' in requested)]
+        rows, has_more = await self.repository.users_page(columns, super_user, limit, cursor)
+
+        items = [user_dict(row, requested, fullname='fullname' in requested) for row in rows]
+        return UserPage.model_construct(items=items, next_cursor=rows[-1]['id'] if has_more else None)
     
-    def get_user_by_id(self, user_id: int, super_user: bool):
-        if not self.repository.user_exist_by_id(user_id):
+    async def get_all_users_body(self, super_user: bool, limit: int, cursor: int | None = None, fields: str | None = None) -> bytes:
+        '''Serialized `get_all_users` page, served from the response cache until a user write'''
+
+        key = await response_cache.key('all', 'superuser' if super_user else 'public', ['users'], limit, cursor, fields)
+        body = None if self.db.info.get('fresh') else await response_cache.get(key)
+        if body is None:
+            page = await self.get_all_users(super_user, limit, cursor, fields)
+            body = orjson.dumps({'items': page.items, 'next_cursor': page.next_cursor})
+            await response_cache.set(key, body, self._cache_ttl())
+        return body
+
+    async def search_users(self, super_user: bool, q: str, limit: int, cursor: str | None = None) -> SearchPage:
+        terms = re.findall(r'\w+', q.lower())[:settings.SEARCH_MAX_TERMS]
+        if not terms:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='search query must contain a word')
+
+        fields = SUPERUSER_FIELDS if super_user else PUBLIC_FIELDS
+        after = _read_search_cursor(cursor) if cursor else None
+        rows, has_more = await self.repository.search_users(fields, super_user, terms, limit, after)
+
+        items = [user_dict(row, fields) for row in rows]
+        next_cursor = _search_cursor(rows[-1]['score'], rows[-1]['id']) if has_more else None
+        return SearchPage.model_construct(items=items, next_cursor=next_cursor)
+    
+    @staticmethod
+    async def export_users(session_factory: async_sessionmaker, export_format: str) -> AsyncIterator[str]:
+        # runs after the response has started, so it cannot use the request scoped session
+        async with session_factory() as db:
+            repository = UserRepository(db)
+            if export_format == 'csv':
+                yield ','.join(SUPERUSER_FIELDS) + '\r\n'
+            async for rows in repository.stream_users(SUPERUSER_FIELDS, settings.EXPORT_BATCH_SIZE):
+                if export_format == 'csv':
+                    buffer = io.StringIO()
+                    csv.writer(buffer).writerows([row[field] for field in SUPERUSER_FIELDS] for row in rows)
+                    yield buffer.getvalue()
+                else:
+                    yield ''.join(json.dumps(dict(row), default=str) + '\n' for row in rows)
+    
+    async def import_users(self, body: bytes, content_type: str, verified: bool, writer: str) -> ImportReport:
+        rows = _parse_import(body, content_type)
+        results: list[ImportRowResult] = []
+        seen: set[str] = set()
+        created = 0
+
+        for start in range(0, len(rows), settings.IMPORT_BATCH_SIZE):
+            batch = []
+            for number, row in enumerate(rows[start:start + settings.IMPORT_BATCH_SIZE], start=start + 1):
+                if isinstance(row, str):
+                    results.append(ImportRowResult(row=number, status='invalid', detail=row))
+                    continue
+                try:
+                    user = UserInput(**row)
+                except (ValidationError, TypeError, ValueError) as e:
+                    if isinstance(e, ValidationError):
+                        detail = '; '.join(f"{'.'.join(map(str, error['loc']))}: {error['msg']}" for error in e.errors())
+                    else:
+                        detail = str(e)             # raised by a field validator on a value of the wrong type
+                    results.append(ImportRowResult(row=number, email=str(row.get('email')), status='invalid', detail=detail))
+                    continue
+                if user.email in seen:
+                    results.append(ImportRowResult(row=number, email=user.email, status='duplicate', detail='repeated in upload'))
+                    continue
+                seen.add(user.email)
+                batch.append((number, user))
+
+            if not batch:
+                continue
+            existing = await self.repository.existing_emails([user.email for _, user in batch])       # one set based lookup per batch
+            new_users = []
+            for number, user in batch:
+                if user.email in existing:
+                    results.append(ImportRowResult(row=number, email=user.email, status='duplicate', detail='already registered'))
+                else:
+                    new_users.append((number, user))
+
+            if not new_users:
+                continue
+            try:
+                hashed_passwords = await hashing.hash_passwords_async([user.password for _, user in new_users])
+            except hashing.HashingBusy:
+                # earlier batches are committed already, report these rows instead of failing the upload
+                results.extend(ImportRowResult(row=number, email=user.email, status='error', detail='server busy, retry this row') for number, user in new_users)
+                continue
+            try:
+                await self.repository.bulk_create([
+                    {**user.model_dump(exclude_none=True), 'password': hashed, 'is_verified': verified}
+                    for (_, user), hashed in zip(new_users, hashed_passwords)
+                ], writer)
+            except Exception as e:
+                results.extend(ImportRowResult(row=number, email=user.email, status='error', detail=str(e.__class__.__name__)) for number, user in new_users)
+                continue
+            created += len(new_users)
+            results.extend(ImportRowResult(row=number, email=user.email, status='created') for number, user in new_users)
+
+        results.sort(key=lambda result: result.row)
+        return ImportReport(created=created, failed=len(results) - created, results=results)
+    
+    async def get_user_by_id(self, user_id: int, super_user: bool, if_none_match: str | None = None) -> tuple[bytes | None, str]:
+        '''Returns the serialized profile and its ETag, or (None, ETag) when the client copy is still current'''
+
+        visibility = 'superuser' if super_user else 'public'
+        key = await response_cache.key('user', visibility, [f'user:{user_id}'], user_id)     # generation is read before the query
+        cached = None if self.db.info.get('fresh') else await response_cache.get(key)
+        if cached is not None:
+            etag, _, body = cached.partition(b'\n')
+            etag = etag.decode()
+            return (None if etag_matches(if_none_match, etag) else body), etag
+
+        if if_none_match:
+            exists, updated_at = await self.repository.get_user_version(user_id)
+            if not exists:
+                raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='user not found')
+            etag = make_etag(user_id, updated_at, visibility)
+            if etag_matches(if_none_match, etag):
+                return None, etag
+
+        user = await self.repository.get_user(user_id, super_user)
+        if user is None:
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='user not found')
         
-        return self.repository.get_user(user_id, super_user)
+        fields = SUPERUSER_FIELDS if super_user else PUBLIC_FIELDS
+        body, etag = orjson.dumps(user_dict(user, fields)), make_etag(user_id, user['updated_at'], visibility)
+        await response_cache.set(key, etag.encode() + b'\n' + body, self._cache_ttl())
+        return body, etag
     
-    def forgot_password_service(self, email: str)-> dict:
-        if not self.repository.user_exist(email):
+    async def get_users_by_ids(self, super_user: bool, ids: str) -> UserBatch:
+        try:
+            user_ids = [int(user_id) for user_id in ids.split(',') if user_id.strip()]
+        except ValueError:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='ids must be comma separated integers')
+        if not user_ids or len(user_ids) > settings.BATCH_MAX_IDS:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f'between 1 and {settings.BATCH_MAX_IDS} ids are allowed')
+
+        fields = SUPERUSER_FIELDS if super_user else PUBLIC_FIELDS
+        found = {row['id']: user_dict(row, fields) for row in await self.repository.get_users(list(set(user_ids)), super_user)}
+        return UserBatch.model_construct(
+            items=[found.get(user_id) for user_id in user_ids],
+            missing=[user_id for user_id in user_ids if user_id not in found],
+        )
+
+    async def forgot_password_service(self, email: str)-> dict:
+        user_instance = await self.repository.get_user_by_email(email)
+        if user_instance is None:
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='user not found')
         
-        user_context = self.repository.get_user_context(email)
-        token = hashing.hash_data(user_context)
-        identity = encode_decode.encode_data(email)
-        self.background_task.add_task(                          # sending email verify mail to the registered user
-                send_email_background,
-                'Forgot Password Mail',
-                email,
-                'forgot_password_template.html',
-                {'token': token, 'data': identity}
+        await self.job_repository.enqueue(                      # repeated requests collapse while the mail is pending
+                SEND_LINK,
+                link_job(email, signed_token.RESET_PASSWORD),
+                settings.JOB_MAX_ATTEMPTS,
+                dedup_key=f'forgot-password:{email}',
                 )
         
         return {'detail' : 'A mail has been send to reset your password'}
 
 
-    def verify_and_reset_password(self, token: str, data: str, new_password: str) -> dict:
-        email = encode_decode.decode_data(data.strip()).strip()
-        if not self.repository.user_exist(email):
+    async def verify_and_reset_password(self, token: str, data: str, new_password: str) -> dict:
+        payload = self._read_link(token, data, signed_token.RESET_PASSWORD)
+        user_instance = await self.repository.get_user_by_email(payload['sub'])
+        if user_instance is None:
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='user not found')
+
+        self._check_link_version(payload, user_instance)
+        return await self.reset_password(user_instance.email, new_password)
         
-        user_context = self.repository.get_user_context(email)
 
+    async def reset_password(self, email, password) -> dict:
+        new_password = await hashing.hash_password_async(password)
+        result = await self.repository.reset_password(email, new_password)
+        if result is None:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='user not found')
+        await self.token_repository.revoke_user(email)                 # sessions opened with the old password
+        return result
+    
+    def _read_link(self, token: str, data: str, purpose: str) -> dict:
+        # signature, purpose and expiry are checked before touching the database
+        try:
+            payload = signed_token.read_token(token, purpose)
+            if encode_decode.decode_data(data.strip()).strip() != payload['sub']:
+                raise signed_token.InvalidSignedToken('identity mismatch')
+        except ValueError:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='link has expired or invalid')
+        return payload
+
+    def _cache_ttl(self) -> float | None:
+        # a lagging replica may answer with data older than the generation in the key, keep such entries briefly
+        return settings.READ_YOUR_WRITES_SECONDS if self.db.info.get('replica') else None
+
+    def _check_link_version(self, payload: dict, user_instance) -> None:
         try:
-            if hashing.verify_data(user_context, token):
-                new_password = hashing.hash_password(new_password)
-                return self.repository.reset_password(email, new_password)
-            else:
-                raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="link has expired or invalid")
-        except:
+            signed_token.check_version(payload, user_instance.get_context())
+        except signed_token.InvalidSignedToken:
             raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='link has expired or invalid')
-        
 
-    def reset_password(self, email, password) -> dict:
-        new_password = hashing.hash_password(password)
-        return self.repository.reset_password(email, new_password)
-    
-    def update_data(self, email: str, data: UserUpdate):
-        return self.repository.update_data(email, data)
+    async def update_data(self, email: str, data: UserUpdate):
+        return await self.repository.update_data(email, data)
     
-    def delete_user(self, user_id: str, has_permission: bool):
+    async def delete_user(self, user_id: str, has_permission: bool, writer: str):
         if not has_permission:
             raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail='Permission Denied')
-        if self.repository.verify_and_destroy(user_id):
+        if await self.repository.verify_and_destroy(user_id, writer):
             return
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='user not found')
@@ -0,0 +1,98 @@
+import asyncio
+import logging
+import threading
+from datetime import datetime
+from sqlalchemy.ext.asyncio import async_sessionmaker
+from app.repository.activity_repository import ActivityRepository
+from settings import settings
+
+logger = logging.getLogger(__name__)
+
+
+class ActivityBuffer:
+    '''Write behind buffer for login history and last seen times.
+
+    Requests only append in memory. Every `interval` seconds, or as soon as `size` login events are pending,
+    the buffer is written in one batch; repeated last seen updates of a user coalesce into the latest one.
+    Whatever is pending when a worker is killed without shutdown, or when a flush fails, is lost.
+    '''
+
+    def __init__(self, size: int, interval: float):
+        self.size = size
+        self.interval = interval
+        self._events: list[dict] = []
+        self._last_login: dict[int, datetime] = {}
+        self._last_seen: dict[int, datetime] = {}
+        self._lock = threading.Lock()
+        self._session_factory: async_sessionmaker | None = None
+        self._wake: asyncio.Event | None = None
+        self._task: asyncio.Task | None = None
+        self._stopping = False
+
+    def login(self, user_id: int | None, email: str, succeeded: bool, ip: str | None, user_agent: str | None) -> None:
+        now = datetime.now()
+        event = {'user_id': user_id, 'email': email[:128], 'succeeded': succeeded, 'ip': ip, 'user_agent': (user_agent or '')[:256] or None, 'created_at': now}
+        with self._lock:
+            self._events.append(event)
+            if succeeded:
+                self._last_login[user_id] = now
+                self._last_seen[user_id] = now
+            full = len(self._events) >= self.size
+        if full and self._wake is not None:
+            self._wake.set()
+
+    def seen(self, user_id: int) -> None:
+        with self._lock:
+            self._last_seen[user_id] = datetime.now()
+
+    def pending(self) -> int:
+        with self._lock:
+            return len(self._events) + len(self._last_seen.keys() | self._last_login.keys())
+
+    async def flush(self, session_factory: async_sessionmaker | None = None) -> int:
+        '''Write everything pending, returns the number of login events written'''
+
+        session_factory = session_factory or self._session_factory
+        if session_factory is None:
+            return 0
+        with self._lock:
+            events, self._events = self._events, []
+            last_login, self._last_login = self._last_login, {}
+            last_seen, self._last_seen = self._last_seen, {}
+        if not (events or last_login or last_seen):
+            return 0
+        try:
+            async with session_factory() as db:
+                await ActivityRepository(db).save(events, last_login, last_seen)
+        except Exception:
+            logger.exception('dropping %s login events and %s last seen updates', len(events), len(last_seen))
+            return 0
+        return len(events)
+
+    def start(self, session_factory: async_sessionmaker) -> None:
+        self._session_factory = session_factory
+        self._stopping = False
+        self._wake = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def _run(self) -> None:
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            await self.flush()
+
+    async def stop(self) -> None:
+        '''Write what is still pending and end the flush loop, a flush in progress is not interrupted'''
+
+        if self._task is None:
+            return
+        self._stopping = True
+        self._wake.set()
+        await self._task
+        self._task = self._wake = None
+
+
+activity = ActivityBuffer(settings.ACTIVITY_FLUSH_SIZE, settings.ACTIVITY_FLUSH_INTERVAL)
@@ -1,5 +1,66 @@
+import os
+import re
+from sqlalchemy import inspect, text
 from app.config.database import engine
 from app.models.user import User
+from app.models.refresh_token import RefreshToken
+from app.models.job import Job
+from app.models.login_event import LoginEvent
+
+MIGRATIONS_DIRECTORY = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), 'migrations', 'versions')
+
+
+class SchemaOutOfDate(RuntimeError):
+    pass
+
 
 def create_models():
-    User.metadata.create_all(bind = engine)
\ No newline at end of file
+    User.metadata.create_all(bind = engine)
+
+
+def migration_head(directory: str = MIGRATIONS_DIRECTORY) -> str:
+    '''Head revision of the migration scripts, read from the files so alembic is not needed at runtime'''
+
+    revisions, parents = set(), set()
+    for name in os.listdir(directory):
+        if not name.endswith('.py'):
+            continue
+        with open(os.path.join(directory, name)) as f:
+            source = f.read()
+        revision = re.search(r"^revision\b.*?=\s*'(\w+)'", source, re.M)
+        down_revision = re.search(r"^down_revision\b.*?=\s*'(\w+)'", source, re.M)
+        if revision:
+            revisions.add(revision.group(1))
+        if down_revision:
+            parents.add(down_revision.group(1))
+
+    heads = revisions - parents
+    if len(heads) != 1:
+        raise SchemaOutOfDate(f'expected a single migration head, found {sorted(heads)}')
+    return heads.pop()
+
+
+def current_revision() -> str | None:
+    with engine.connect() as connection:
+        if not inspect(connection).has_table('alembic_version'):
+            return None
+        return connection.execute(text('SELECT version_num FROM alembic_version')).scalar()
+
+
+def check_schema() -> None:
+    '''Read only startup check that the database was migrated to the head revision'''
+
+    head, current = migration_head(), current_revision()
+    if current != head:
+        raise SchemaOutOfDate(f'database schema is at {current}, migrations head is {head}, run `alembic upgrade head`')
+
+
+def prepare_schema(mode: str) -> None:
+    '''`check` verifies the migration head, `create` runs create_all (development), `skip` does nothing'''
+
+    if mode == 'create':
+        create_models()
+    elif mode == 'check':
+        check_schema()
+    elif mode != 'skip':
+        raise ValueError(f'unknown DB_SCHEMA mode {mode!r}')
@@ -1,40 +1,153 @@
-from fastapi_mail import FastMail, MessageSchema, ConnectionConfig
-from settings import settings
-from fastapi import BackgroundTasks
 import asyncio
+import logging
+import threading
+import time
+from concurrent.futures import Future
+from email.message import EmailMessage
+from jinja2 import Environment, FileSystemLoader, select_autoescape
+from app.utils import metrics
+from settings import settings
+
+logger = logging.getLogger(__name__)
+
+templates = Environment(loader=FileSystemLoader('templates'), autoescape=select_autoescape(['html']))
+
+
+def render_message(subject: str, email_to: str, template_name: str, body: dict) -> EmailMessage:
+    message = EmailMessage()
+    message['Subject'] = subject
+    message['From'] = settings.MAIL_FROM
+    message['To'] = email_to
+    message.set_content(templates.get_template(template_name).render(**body), subtype='html')
+    return message
+
+
+class Mailer:
+    '''Long lived SMTP delivery.
+
+    Runs its own event loop in a daemon thread with `pool_size` workers. Each worker keeps one
+    authenticated connection open, drains up to `batch_size` queued messages per wake up over
+    it and only closes it after `idle_timeout` seconds without mail.
+    '''
+
+    def __init__(self, pool_size: int, batch_size: int, idle_timeout: float):
+        self.pool_size = pool_size
+        self.batch_size = batch_size
+        self.idle_timeout = idle_timeout
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._queue: asyncio.Queue | None = None
+        self._thread: threading.Thread | None = None
+        self._lock = threading.Lock()
+
+    def _connection(self) -> 'aiosmtplib.SMTP':
+        import aiosmtplib                                   # imported by the mailer thread, not at startup
+        return aiosmtplib.SMTP(
+            hostname=settings.MAIL_SERVER,
+            port=settings.MAIL_PORT,
+            username=settings.MAIL_USERNAME if settings.MAIL_USE_CREDENTIALS else None,
+            password=settings.MAIL_PASSWORD if settings.MAIL_USE_CREDENTIALS else None,
+            use_tls=settings.MAIL_SSL_TLS,
+            start_tls=settings.MAIL_STARTTLS,
+        )
+
+    def start(self) -> None:
+        with self._lock:
+            if self._thread is not None:
+                return
+            ready = threading.Event()
+            self._thread = threading.Thread(target=self._run, args=(ready,), name='mailer', daemon=True)
+            self._thread.start()
+            ready.wait()
+
+    def _run(self, ready: threading.Event) -> None:
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        self._queue = asyncio.Queue()
+        workers = [self._loop.create_task(self._worker()) for _ in range(self.pool_size)]
+        ready.set()
+        self._loop.run_until_complete(asyncio.gather(*workers))
+        self._loop.close()
+
+    def send(self, message: EmailMessage) -> Future:
+        '''Queue `message` from any thread, the returned future resolves once the server accepted it'''
+
+        self.start()
+        future = Future()
+        self._loop.call_soon_threadsafe(self._queue.put_nowait, (message, future))
+        return future
+
+    def stop(self, timeout: float = 10) -> None:
+        '''Deliver what is already queued, then close every connection'''
+
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is None:
+            return
+        for _ in range(self.pool_size):
+            self._loop.call_soon_threadsafe(self._queue.put_nowait, None)
+        thread.join(timeout)
+
+    async def _worker(self) -> None:
+        smtp = None
+        stopping = False
+        while not stopping:
+            try:
+                item = await asyncio.wait_for(self._queue.get(), self.idle_timeout)
+            except asyncio.TimeoutError:
+                smtp = await self._close(smtp)
+                continue
+            if item is None:
+                break
+
+            batch = [item]
+            while len(batch) < self.batch_size and not self._queue.empty():
+                next_item = self._queue.get_nowait()
+                if next_item is None:
+                    stopping = True
+                    break
+                batch.append(next_item)
+
+            for message, future in batch:
+                start = time.perf_counter()
+                try:
+                    smtp = await self._deliver(smtp, message)
+                    future.set_result(True)
+                except Exception as e:
+                    logger.exception('sending %r to %s failed', message['Subject'], message['To'])
+                    metrics.email_send_failures.inc()
+                    smtp = await self._close(smtp)
+                    future.set_exception(e)
+                finally:
+                    metrics.email_send_duration.observe(time.perf_counter() - start)
+        await self._close(smtp)
+
+    async def _deliver(self, smtp: 'aiosmtplib.SMTP | None', message: EmailMessage) -> 'aiosmtplib.SMTP':
+        import aiosmtplib
+        for attempt in range(2):
+            if smtp is None or not smtp.is_connected:
+                smtp = self._connection()
+                await smtp.connect()
+            try:
+                await smtp.send_message(message)
+                return smtp
+            except aiosmtplib.SMTPServerDisconnected:
+                smtp = None                                 # pooled connection went stale, reconnect once
+                if attempt:
+                    raise
+        return smtp
+
+    async def _close(self, smtp: 'aiosmtplib.SMTP | None') -> None:
+        import aiosmtplib
+        if smtp is not None and smtp.is_connected:
+            try:
+                await smtp.quit()
+            except aiosmtplib.SMTPException:
+                smtp.close()
+        return None
+
+
+mailer = Mailer(settings.MAIL_POOL_SIZE, settings.MAIL_BATCH_SIZE, settings.MAIL_IDLE_TIMEOUT)
+
 
-conf = ConnectionConfig(
-    MAIL_USERNAME=settings.MAIL_USERNAME,
-    MAIL_PASSWORD=settings.MAIL_PASSWORD,
-    MAIL_FROM=settings.MAIL_USERNAME,
-    MAIL_PORT=settings.MAIL_PORT,
-    MAIL_SERVER=settings.MAIL_SERVER,
-    MAIL_FROM_NAME=settings.MAIL_USERNAME,
-    MAIL_STARTTLS=True,    
-    MAIL_SSL_TLS=False, 
-    USE_CREDENTIALS=True,
-    TEMPLATE_FOLDER='templates'
-)
-
-async def send_email_async(subject: str, email_to: str, body: dict):
-    message = MessageSchema(
-        subject=subject,
-        recipients=[email_to],
-        template_body=body,
-        subtype='html',
-    )
-    
-    fm = FastMail(conf)
-    await fm.send_message(message, template_name='verify_email_template.html')
-
-
-def send_email_background(subject: str, email_to: str, template_name: str, body: dict):
-    message = MessageSchema(
-        subject=subject,
-        recipients=[email_to],
-        template_body=body,
-        subtype='html',
-    )
-    fm = FastMail(conf)
-
-    asyncio.run(fm.send_message(message, template_name=f'{template_name}'))
\ No newline at end of file
+def send_email_background(subject: str, email_to: str, template_name: str, body: dict) -> Future:
+    return mailer.send(render_message(subject, email_to, template_name, body))
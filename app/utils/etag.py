@@ -0,0 +1,17 @@
+import hashlib
+from datetime import datetime
+
+
+def make_etag(user_id: int, updated_at: datetime | None, visibility: str) -> str:
+    '''Strong validator for one user representation, changes with every write (updated_at)'''
+
+    version = updated_at.isoformat() if updated_at else ''
+    digest = hashlib.sha1(f'{user_id}:{version}:{visibility}'.encode('utf-8')).hexdigest()[:20]
+    return f'"{digest}"'
+
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    if not if_none_match:
+        return False
+    candidates = {candidate.strip().removeprefix('W/') for candidate in if_none_match.split(',')}
+    return '*' in candidates or etag in candidates
@@ -0,0 +1,121 @@
+import asyncio
+import json
+import logging
+import random
+from typing import Awaitable, Callable
+from sqlalchemy.ext.asyncio import async_sessionmaker
+from app.repository.job_repository import JobRepository
+from app.repository.user_repository import UserRepository
+from app.security import encode_decode, signed_token
+from app.utils.email_util import send_email_background
+from settings import settings
+
+logger = logging.getLogger(__name__)
+
+SEND_LINK = 'send_link'
+
+# purpose of the signed link: subject, template, lifetime setting and whether the account must be verified
+LINK_MAILS = {
+    signed_token.VERIFY_ACCOUNT: ('Account Verification', 'verify_email_template.html', 'VERIFY_LINK_EXPIRE_MINUTES', False),
+    signed_token.RESET_PASSWORD: ('Forgot Password Mail', 'forgot_password_template.html', 'RESET_LINK_EXPIRE_MINUTES', True),
+}
+
+
+async def send_link(payload: dict, session_factory: async_sessionmaker) -> None:
+    '''Mail a verify or reset link, the token is only created here so the queue never holds a usable link'''
+
+    subject, template_name, expire_setting, verified_only = LINK_MAILS[payload['purpose']]
+    async with session_factory() as db:
+        user_instance = await UserRepository(db).get_user_by_email(payload['email'], verified_only)
+    if user_instance is None:
+        logger.info('%s link for %s dropped, no such account anymore', payload['purpose'], payload['email'])
+        return
+
+    token = signed_token.create_token(
+        user_instance.email,
+        payload['purpose'],
+        user_instance.get_context(),
+        getattr(settings, expire_setting) * 60,
+        )
+    body = {'token': token, 'data': encode_decode.encode_data(user_instance.email)}
+    # done once the SMTP server accepted the message, a refusal fails the job and it is retried
+    await asyncio.wrap_future(send_email_background(subject, user_instance.email, template_name, body))
+
+
+HANDLERS: dict[str, Callable[[dict, async_sessionmaker], Awaitable[None]]] = {
+    SEND_LINK: send_link,
+}
+
+
+def link_job(email: str, purpose: str) -> dict:
+    return {'email': email, 'purpose': purpose}
+
+
+def backoff(attempts: int) -> float:
+    '''Seconds before retry number `attempts`, doubling from JOB_BACKOFF_BASE up to JOB_BACKOFF_MAX with jitter'''
+
+    delay = min(settings.JOB_BACKOFF_MAX, settings.JOB_BACKOFF_BASE * 2 ** (attempts - 1))
+    return delay * random.uniform(0.5, 1)
+
+
+class Worker:
+    '''Runs queued jobs, at most `concurrency` at a time.
+
+    A job is leased for `lease` seconds, when its worker dies the lease runs out and another worker
+    picks it up. Failures are retried with `backoff` until max_attempts, then the job is dead lettered.
+    '''
+
+    def __init__(self, session_factory: async_sessionmaker, concurrency: int, poll_interval: float, lease: float):
+        self.session_factory = session_factory
+        self.concurrency = concurrency
+        self.poll_interval = poll_interval
+        self.lease = lease
+
+    async def _claim(self, limit: int) -> list:
+        async with self.session_factory() as db:
+            return await JobRepository(db).claim(limit, self.lease)
+
+    async def _execute(self, job) -> None:
+        try:
+            handler = HANDLERS.get(job.kind)
+            if handler is None:
+                raise LookupError(f'no handler for job kind {job.kind!r}')
+            await asyncio.wait_for(handler(json.loads(job.payload), self.session_factory), self.lease)     # past the lease another worker may run it
+        except Exception as e:
+            error = f'{e.__class__.__name__}: {e}'
+            async with self.session_factory() as db:
+                if job.attempts >= job.max_attempts:
+                    logger.error('job %s (%s) dead lettered after %s attempts: %s', job.id, job.kind, job.attempts, error)
+                    await JobRepository(db).dead_letter(job.id, error)
+                else:
+                    logger.warning('job %s (%s) attempt %s failed: %s', job.id, job.kind, job.attempts, error)
+                    await JobRepository(db).retry(job.id, backoff(job.attempts), error)
+            return
+
+        async with self.session_factory() as db:
+            await JobRepository(db).complete(job.id)
+
+    async def run_once(self) -> int:
+        '''Run one batch of due jobs to completion, returns how many were claimed'''
+
+        jobs = await self._claim(self.concurrency)
+        await asyncio.gather(*(self._execute(job) for job in jobs))
+        return len(jobs)
+
+    async def run(self, stop: asyncio.Event) -> None:
+        '''Keep every slot busy until `stop` is set, then let the running jobs finish'''
+
+        running: set[asyncio.Task] = set()
+        stopping = asyncio.ensure_future(stop.wait())
+        while not stop.is_set():
+            free = self.concurrency - len(running)
+            if free:
+                try:
+                    running.update(asyncio.create_task(self._execute(job)) for job in await self._claim(free))
+                except Exception:
+                    logger.exception('claiming jobs failed')
+            # full: wait for a slot, otherwise the queue is drained: poll again later
+            timeout = None if len(running) >= self.concurrency else self.poll_interval
+            done, _ = await asyncio.wait({*running, stopping}, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            running -= done
+        await asyncio.gather(*running)
@@ -0,0 +1,122 @@
+import logging
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Iterator
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from app.utils import metrics
+from settings import settings
+
+logger = logging.getLogger(__name__)
+
+COUNT_HEADER = 'X-DB-Query-Count'
+TIME_HEADER = 'X-DB-Query-Time'
+BUDGET_HEADER = 'X-DB-Query-Budget'
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+class QueryStats:
+    '''Statements executed (and time spent in the driver) inside one request or block'''
+
+    def __init__(self, budget: int | None = None):
+        self.budget = budget
+        self.count = 0
+        self.duration = 0.0
+        self.statements: list[str] = []
+
+    def record(self, statement: str, duration: float) -> None:
+        self.count += 1
+        self.duration += duration
+        self.statements.append(statement)
+
+    @property
+    def over_budget(self) -> bool:
+        return self.budget is not None and self.count > self.budget
+
+    def check(self) -> None:
+        if self.over_budget:
+            raise QueryBudgetExceeded(
+                f'{self.count} queries executed, budget is {self.budget}:\n' + '\n'.join(self.statements)
+            )
+
+
+_current_stats: ContextVar[QueryStats | None] = ContextVar('query_stats', default=None)
+
+
+def current_stats() -> QueryStats | None:
+    return _current_stats.get()
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    duration = time.perf_counter() - conn.info['query_start'].pop()
+    operation = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else 'UNKNOWN'
+    metrics.db_statements.inc(operation=operation)
+    metrics.db_statement_duration.observe(duration, operation=operation)
+    stats = _current_stats.get()
+    if stats is not None:
+        stats.record(statement, duration)
+
+
+@contextmanager
+def track_queries(budget: int | None = None) -> Iterator[QueryStats]:
+    '''Count the statements executed in this context, raising QueryBudgetExceeded when over `budget`'''
+
+    stats = QueryStats(budget)
+    token = _current_stats.set(stats)
+    try:
+        yield stats
+    finally:
+        _current_stats.reset(token)
+    stats.check()
+
+
+def query_budget(limit: int):
+    '''Route dependency declaring how many statements the route may issue'''
+
+    def _declare_budget() -> None:
+        stats = _current_stats.get()
+        if stats is not None:
+            stats.budget = limit
+    return _declare_budget
+
+
+class QueryStatsMiddleware:
+    '''Tracks the statements of every request, reported in response headers when QUERY_STATS_HEADERS is on'''
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        stats = QueryStats()
+        token = _current_stats.set(stats)
+
+        async def send_with_stats(message):
+            if message['type'] == 'http.response.start':
+                if stats.over_budget:
+                    logger.warning('%s %s issued %d queries (budget %d)', scope['method'], scope['path'], stats.count, stats.budget)
+                if settings.QUERY_STATS_HEADERS:            # internal timings, not for production clients
+                    headers = list(message.get('headers', []))
+                    headers.append((COUNT_HEADER.encode(), str(stats.count).encode()))
+                    headers.append((TIME_HEADER.encode(), f'{stats.duration * 1000:.3f}'.encode()))
+                    if stats.budget is not None:
+                        headers.append((BUDGET_HEADER.encode(), str(stats.budget).encode()))
+                    message['headers'] = headers
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_stats)
+        finally:
+            _current_stats.reset(token)
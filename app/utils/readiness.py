@@ -0,0 +1,47 @@
+import asyncio
+import logging
+import time
+from jinja2 import Environment
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncEngine
+from app.security import hashing
+
+logger = logging.getLogger(__name__)
+
+_ready = False
+_warm_up_task: asyncio.Task | None = None
+
+
+def is_ready() -> bool:
+    return _ready
+
+
+async def _open_pool(engine: AsyncEngine, size: int) -> None:
+    async def ping():
+        async with engine.connect() as connection:
+            await connection.execute(text('SELECT 1'))
+    await asyncio.gather(*(ping() for _ in range(size)))       # concurrent, so `size` connections stay pooled
+
+
+async def warm_up(engine: AsyncEngine, pool_size: int, template_environments: list[Environment]) -> None:
+    '''Open the DB pool, start the hashing processes and compile every template, then report ready'''
+
+    global _ready
+    start = time.perf_counter()
+    try:
+        for environment in template_environments:
+            for name in environment.list_templates():
+                environment.get_template(name)
+        await asyncio.gather(_open_pool(engine, pool_size), hashing.warm_up())
+    except Exception:
+        logger.exception('warm up failed, the worker stays unready')
+        return
+    _ready = True
+    logger.info('warm up done in %.3fs', time.perf_counter() - start)
+
+
+def start_warm_up(*args) -> None:
+    '''Warm up in the background, the worker accepts connections while /internal/ready answers 503'''
+
+    global _warm_up_task
+    _warm_up_task = asyncio.get_running_loop().create_task(warm_up(*args))
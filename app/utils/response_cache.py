@@ -0,0 +1,250 @@
+import asyncio
+import importlib
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from abc import ABC, abstractmethod
+from app.utils.cache import TTLCache
+from settings import settings
+
+logger = logging.getLogger(__name__)
+
+WRITER_KEY = 'writer:{}'                # marks a principal that wrote in the last READ_YOUR_WRITES_SECONDS
+
+
+class CacheBackend(ABC):
+    '''Byte values with a lifetime plus integer counters, implement it to share the cache between workers'''
+
+    @abstractmethod
+    async def get(self, key: str) -> bytes | None:
+        ...
+
+    @abstractmethod
+    async def set(self, key: str, value: bytes, ttl: float) -> None:
+        ...
+
+    @abstractmethod
+    async def incr(self, key: str) -> int:
+        ...
+
+    @abstractmethod
+    async def counter(self, key: str) -> int:
+        ...
+
+
+class MemoryCacheBackend(CacheBackend):
+    '''Per process LRU, only correct with a single worker since the counters are not shared'''
+
+    def __init__(self):
+        self._entries = TTLCache(settings.RESPONSE_CACHE_SIZE, settings.RESPONSE_CACHE_TTL)
+        self._counters: dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    async def get(self, key: str) -> bytes | None:
+        return self._entries.get(key)
+
+    async def set(self, key: str, value: bytes, ttl: float) -> None:
+        self._entries.set(key, value, ttl)
+
+    async def incr(self, key: str) -> int:
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + 1
+            return self._counters[key]
+
+    async def counter(self, key: str) -> int:
+        return self._counters.get(key, 0)
+
+
+class SQLiteCacheBackend(CacheBackend):
+    '''Entries and counters in a SQLite file (on tmpfs when available) shared by every worker on the host.
+
+    Statements run in the default thread pool, a worker holding the write lock for longer than TIMEOUT
+    turns the call into an error, which the ResponseCache treats as a miss.
+    '''
+
+    TIMEOUT = 0.5                       # seconds to wait for another worker's write lock
+    PURGE_EVERY = 100                   # sets between deletions of expired entries and entries beyond the size
+
+    def __init__(self, path: str | None = None, maxsize: int | None = None):
+        shm = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+        self.path = path or os.path.join(shm, 'profilely-response-cache.sqlite')
+        self.maxsize = settings.RESPONSE_CACHE_SIZE if maxsize is None else maxsize
+        self._local = threading.local()
+        self._sets = 0
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=self.TIMEOUT, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=OFF')                # a cache, losing it on power loss is fine
+            connection.execute('CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value BLOB, expires REAL)')
+            connection.execute('CREATE INDEX IF NOT EXISTS entries_expires ON entries (expires)')
+            connection.execute('CREATE TABLE IF NOT EXISTS counters (key TEXT PRIMARY KEY, value INTEGER)')
+            self._local.connection = connection
+        return connection
+
+    def _get(self, key: str) -> bytes | None:
+        row = self._connection().execute('SELECT value FROM entries WHERE key = ? AND expires > ?', (key, time.time())).fetchone()
+        return row[0] if row else None
+
+    def _set(self, key: str, value: bytes, ttl: float, purge: bool) -> None:
+        connection = self._connection()
+        connection.execute('INSERT OR REPLACE INTO entries (key, value, expires) VALUES (?, ?, ?)', (key, value, time.time() + ttl))
+        if purge:
+            # keeps the `maxsize` most recently written entries, a replaced entry gets a new rowid
+            connection.execute(
+                'DELETE FROM entries WHERE expires <= ? OR rowid IN (SELECT rowid FROM entries ORDER BY rowid DESC LIMIT -1 OFFSET ?)',
+                (time.time(), self.maxsize),
+            )
+
+    def _incr(self, key: str) -> int:
+        return self._connection().execute(
+            'INSERT INTO counters (key, value) VALUES (?, 1) ON CONFLICT (key) DO UPDATE SET value = value + 1 RETURNING value', (key,)
+        ).fetchone()[0]
+
+    def _counter(self, key: str) -> int:
+        row = self._connection().execute('SELECT value FROM counters WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else 0
+
+    async def get(self, key: str) -> bytes | None:
+        return await asyncio.to_thread(self._get, key)
+
+    async def set(self, key: str, value: bytes, ttl: float) -> None:
+        self._sets += 1
+        await asyncio.to_thread(self._set, key, value, ttl, self._sets % self.PURGE_EVERY == 0)
+
+    async def incr(self, key: str) -> int:
+        return await asyncio.to_thread(self._incr, key)
+
+    async def counter(self, key: str) -> int:
+        return await asyncio.to_thread(self._counter, key)
+
+
+class LocalKV:
+    '''In process stand-in for a redis.asyncio client, implements the get / set(ex=) / incr subset KVCacheBackend uses'''
+
+    def __init__(self):
+        self._data: dict[str, tuple[float | None, bytes]] = {}
+
+    async def get(self, name: str) -> bytes | None:
+        entry = self._data.get(name)
+        if entry is None or (entry[0] is not None and entry[0] <= time.time()):
+            return None
+        return entry[1]
+
+    async def set(self, name: str, value: bytes, ex: float | None = None) -> None:
+        self._data[name] = (time.time() + ex if ex else None, value)
+
+    async def incr(self, name: str) -> int:
+        value = int(await self.get(name) or 0) + 1                  # no await between the read and the write
+        self._data[name] = (None, str(value).encode())
+        return value
+
+
+class KVCacheBackend(CacheBackend):
+    '''External key value store (Redis protocol) from RESPONSE_CACHE_KV_URL, LocalKV when no url is set'''
+
+    def __init__(self, client=None):
+        if client is None and settings.RESPONSE_CACHE_KV_URL:
+            import redis.asyncio                                        # only needed for this backend
+            client = redis.asyncio.Redis.from_url(settings.RESPONSE_CACHE_KV_URL)
+        self.client = client if client is not None else LocalKV()
+
+    async def get(self, key: str) -> bytes | None:
+        return await self.client.get(key)
+
+    async def set(self, key: str, value: bytes, ttl: float) -> None:
+        await self.client.set(key, value, ex=max(1, int(ttl)))
+
+    async def incr(self, key: str) -> int:
+        return await self.client.incr(key)
+
+    async def counter(self, key: str) -> int:
+        return int(await self.client.get(key) or 0)
+
+
+class ResponseCache:
+    '''Serialized responses keyed by route, visibility and generation counters.
+
+    Writes bump the `users` generation (lists) and the `user:<id>` generation (one profile), which changes the key
+    of every affected entry at once; the stale entries are never read again and age out with their ttl.
+    A failing backend never fails the request: the key is None and the response is built from the database.
+    '''
+
+    def __init__(self, backend: CacheBackend, ttl: float):
+        self.backend = backend
+        self.ttl = ttl
+
+    async def generation(self, name: str) -> int | None:
+        '''Current value of the `name` generation, None when the backend is unavailable'''
+
+        try:
+            return await self.backend.counter(f'gen:{name}')
+        except Exception as e:
+            logger.warning('response cache unavailable: %r', e)
+            return None
+
+    async def key(self, route: str, visibility: str, generations: list[str], *parts) -> str | None:
+        try:
+            versions = ','.join([f'{name}={await self.backend.counter(f"gen:{name}")}' for name in generations])
+        except Exception as e:
+            logger.warning('response cache unavailable, serving from the database: %r', e)
+            return None
+        return ':'.join(map(str, ('response', route, visibility, versions, *parts)))
+
+    async def get(self, key: str | None) -> bytes | None:
+        if key is None:
+            return None
+        try:
+            return await self.backend.get(key)
+        except Exception as e:
+            logger.warning('response cache read failed: %r', e)
+            return None
+
+    async def set(self, key: str | None, body: bytes, ttl: float | None = None) -> None:
+        if key is None:
+            return
+        try:
+            await self.backend.set(key, body, self.ttl if ttl is None else ttl)
+        except Exception as e:
+            logger.warning('response cache write failed: %r', e)
+
+    async def mark_writer(self, email: str) -> None:
+        '''Sends the reads of `email` to the primary for READ_YOUR_WRITES_SECONDS, on every worker'''
+
+        try:
+            await self.backend.set(WRITER_KEY.format(email), b'1', settings.READ_YOUR_WRITES_SECONDS)
+        except Exception as e:
+            logger.warning('marking %s as a recent writer failed: %r', email, e)
+
+    async def wrote_recently(self, email: str) -> bool:
+        try:
+            return await self.backend.get(WRITER_KEY.format(email)) is not None
+        except Exception as e:
+            logger.warning('response cache read failed: %r', e)
+            return True                                                 # unknown, the primary is always current
+
+    async def bump(self, user_id: int | None = None, email: str | None = None) -> None:
+        '''Bumps the list generation, plus the profile and principal generations of the written user'''
+
+        try:
+            await self.backend.incr('gen:users')
+            if user_id is not None:
+                await self.backend.incr(f'gen:user:{user_id}')
+            if email is not None:
+                await self.backend.incr(f'gen:principal:{email}')
+        except Exception:
+            # the write itself is committed, entries it made stale are served until their ttl runs out
+            logger.exception('bumping the response cache generation failed')
+
+
+def load_backend(path: str) -> CacheBackend:
+    module_name, class_name = path.rsplit('.', 1)
+    return getattr(importlib.import_module(module_name), class_name)()
+
+
+response_cache = ResponseCache(load_backend(settings.RESPONSE_CACHE_BACKEND), settings.RESPONSE_CACHE_TTL)
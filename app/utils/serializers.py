@@ -0,0 +1,22 @@
+from typing import Any, Iterable, Mapping
+from fastapi.responses import ORJSONResponse
+from app.schemas.response_schemas import UserOutput
+
+
+def user_dict(row: Mapping[str, Any], fields: Iterable[str], fullname: bool = True) -> dict:
+    '''Output of a user row, equivalent to UserOutput with response_model_exclude_none'''
+
+    data = {field: row[field] for field in fields if field != 'fullname' and row[field] is not None}
+    if fullname:
+        data['fullname'] = f'{row["first_name"]} {row["last_name"]}'
+    return data
+
+
+def principal_dict(user: UserOutput) -> dict:
+    return user.model_dump(exclude_none=True)
+
+
+def json_response(content: Any, status_code: int = 200, headers: dict | None = None) -> ORJSONResponse:
+    '''Encodes with orjson and, being a Response, skips FastAPI's response_model validation pass'''
+
+    return ORJSONResponse(content, status_code=status_code, headers=headers)
@@ -0,0 +1,112 @@
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PASSWORD = 'hello123@dinoPG'
+
+
+def configure(database_url: str) -> None:
+    '''Environment for importing the app outside of a deployment, must run before any `app` import'''
+
+    sys.path.insert(0, ROOT)
+    os.chdir(ROOT)                                                  # templates and static are resolved relative to the root
+    os.environ['DATABASE_URL'] = database_url
+    os.environ.setdefault('SECRET_KEY', 'benchmark-secret')
+    os.environ.setdefault('ALGORITHM', 'HS256')
+    os.environ.setdefault('MAIL_USERNAME', 'benchmark@example.com')
+    os.environ.setdefault('MAIL_PASSWORD', 'benchmark')
+    os.environ.setdefault('RATE_LIMIT_IP_PER_MINUTE', '100000000')        # the load scenario comes from a single client
+    os.environ.setdefault('RATE_LIMIT_ACCOUNT_PER_MINUTE', '100000000')
+    os.environ.setdefault('RATE_LIMIT_BURST', '100000000')
+
+
+def seed_users(count: int) -> None:
+    '''Recreate the schema and insert `count` verified users sharing one password hash, user 1 is a superuser'''
+
+    from sqlalchemy import insert
+    from app.config.database import engine, Base
+    from app.models.user import User
+    from app.security.hashing import hash_password
+    import app.utils.db_init                                        # registers every model, not only users, with Base.metadata
+
+    Base.metadata.drop_all(bind=engine)
+    Base.metadata.create_all(bind=engine)
+    password = hash_password(PASSWORD)
+    with engine.begin() as connection:
+        for start in range(0, count, 1000):
+            connection.execute(insert(User), [
+                {
+                    'first_name': f'User{i}',
+                    'last_name': 'Bench',
+                    'email': user_email(i),
+                    'password': password,
+                    'bio': 'benchmark user',
+                    'is_verified': True,
+                    'is_superuser': i == 0,
+                }
+                for i in range(start, min(start + 1000, count))
+            ])
+
+
+def user_email(i: int) -> str:
+    return f'user{i}@bench.example.com'
+
+
+def summarize(durations: list[float], elapsed: float | None = None) -> dict:
+    '''Latency percentiles in milliseconds, plus throughput when the wall clock `elapsed` is known'''
+
+    ordered = sorted(durations)
+    quantiles = statistics.quantiles(ordered, n=100, method='inclusive') if len(ordered) > 1 else ordered * 99
+    result = {
+        'count': len(ordered),
+        'mean_ms': statistics.fmean(ordered) * 1000,
+        'p50_ms': quantiles[49] * 1000,
+        'p95_ms': quantiles[94] * 1000,
+        'p99_ms': quantiles[98] * 1000,
+        'max_ms': ordered[-1] * 1000,
+    }
+    if elapsed:
+        result['throughput_rps'] = len(ordered) / elapsed
+    return result
+
+
+def _git_revision() -> str | None:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT, text=True, stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def write_results(kind: str, parameters: dict, results: dict, output: str | None) -> str:
+    '''Save a run as JSON (under benchmarks/results by default) so runs can be diffed'''
+
+    report = {
+        'benchmark': kind,
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'revision': _git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'parameters': parameters,
+        'results': results,
+    }
+    if output is None:
+        directory = os.path.join(ROOT, 'benchmarks', 'results')
+        os.makedirs(directory, exist_ok=True)
+        output = os.path.join(directory, f'{kind}-{time.strftime("%Y%m%d-%H%M%S")}.json')
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    return output
+
+
+def print_table(results: dict) -> None:
+    print(f'{"name":<36}{"count":>8}{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}{"rps":>10}')
+    for name, row in results.items():
+        rps = f'{row["throughput_rps"]:.1f}' if 'throughput_rps' in row else '-'
+        print(f'{name:<36}{row["count"]:>8}{row["p50_ms"]:>10.3f}{row["p95_ms"]:>10.3f}{row["p99_ms"]:>10.3f}{rps:>10}')
@@ -0,0 +1,27 @@
+'''Compare two saved benchmark runs: python -m benchmarks.compare before.json after.json'''
+
+import argparse
+import json
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('before')
+    parser.add_argument('after')
+    parser.add_argument('--metric', default='p95_ms')
+    args = parser.parse_args()
+
+    with open(args.before) as f:
+        before = json.load(f)['results']
+    with open(args.after) as f:
+        after = json.load(f)['results']
+
+    print(f'{"name":<36}{"before":>12}{"after":>12}{"change":>10}')
+    for name in sorted(before.keys() & after.keys()):
+        old, new = before[name][args.metric], after[name][args.metric]
+        change = f'{(new - old) / old * 100:+.1f}%' if old else '-'
+        print(f'{name:<36}{old:>12.3f}{new:>12.3f}{change:>10}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+'''End to end load scenario against the ASGI app: python -m benchmarks.load [--users 10000] [--requests 2000] [--concurrency 32]
+
+Seeds `--users` synthetic users into SQLite (default) or the Postgres given by --database-url, then drives every
+route with `--concurrency` concurrent clients in process (no network, so the numbers are the app's own cost).
+'''
+
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import time
+from benchmarks.common import PASSWORD, configure, print_table, seed_users, summarize, user_email, write_results
+
+
+def scenarios(users: int, token: str, super_token: str) -> dict:
+    '''route name -> factory of (method, url, request kwargs)'''
+
+    headers = {'Authorization': f'Bearer {token}'}
+    super_headers = {'Authorization': f'Bearer {super_token}'}
+    return {
+        'POST /user/login': lambda: ('POST', '/user/login', {'data': {'username': user_email(random.randrange(users)), 'password': PASSWORD}}),
+        'GET /user/me': lambda: ('GET', '/user/me', {'headers': headers}),
+        'GET /user/{user_id}': lambda: ('GET', f'/user/{random.randint(1, users)}', {'headers': headers}),
+        'GET /user/all': lambda: ('GET', '/user/all', {'headers': headers, 'params': {'limit': 50}}),
+        'GET /user/all (superuser, cursor)': lambda: ('GET', '/user/all', {
+            'headers': super_headers,
+            'params': {'limit': 50, 'cursor': random.randrange(users)},
+        }),
+    }
+
+
+async def drive(client, make_request, requests: int, concurrency: int) -> dict:
+    durations, errors = [], 0
+    remaining = requests
+
+    async def worker():
+        nonlocal remaining, errors
+        while remaining > 0:
+            remaining -= 1
+            method, url, kwargs = make_request()
+            start = time.perf_counter()
+            response = await client.request(method, url, **kwargs)
+            durations.append(time.perf_counter() - start)
+            if response.status_code >= 400:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    result = summarize(durations, time.perf_counter() - start)
+    result['errors'] = errors
+    return result
+
+
+async def run(users: int, requests: int, concurrency: int, routes: list[str] | None) -> dict:
+    import httpx
+    from main import app
+    from app.config.database import async_engine
+    from app.security import hashing
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url='http://bench') as client:
+        tokens = []
+        for i in (1, 0):
+            response = await client.post('/user/login', data={'username': user_email(i), 'password': PASSWORD})
+            response.raise_for_status()
+            tokens.append(response.json()['access_token'])
+
+        results = {}
+        for name, make_request in scenarios(users, *tokens).items():
+            if routes and name not in routes:
+                continue
+            # login is bcrypt bound, a tenth of the requests is enough for stable percentiles
+            count = max(concurrency, requests // 10) if name.startswith('POST /user/login') else requests
+            results[name] = await drive(client, make_request, count, concurrency)
+    hashing.shutdown_executor()
+    await async_engine.dispose()
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--requests', type=int, default=2000, help='requests per route')
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--route', action='append', dest='routes', help='only run this scenario, may be repeated')
+    parser.add_argument('--database-url', default=f'sqlite:///{os.path.join(tempfile.gettempdir(), "profilely-bench.db")}',
+                        help='database to seed, it is dropped and recreated')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='JSON file for the results')
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    configure(args.database_url)
+    seed_users(args.users)
+    results = asyncio.run(run(args.users, args.requests, args.concurrency, args.routes))
+    print_table(results)
+    parameters = {
+        'users': args.users,
+        'requests': args.requests,
+        'concurrency': args.concurrency,
+        'seed': args.seed,
+        'database': args.database_url.split('://')[0],
+    }
+    path = write_results('load', parameters, results, args.output)
+    print(f'\nresults written to {path}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+'''Microbenchmarks of the hot paths: python -m benchmarks.micro [--users 1000] [--database-url ...]'''
+
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+from benchmarks.common import PASSWORD, configure, print_table, seed_users, summarize, user_email, write_results
+
+
+def measure(func, iterations: int) -> dict:
+    func()                                                          # warm up caches and lazy imports
+    durations = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        func()
+        durations.append(time.perf_counter() - start)
+    return summarize(durations)
+
+
+async def measure_async(func, iterations: int) -> dict:
+    await func()
+    durations = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        await func()
+        durations.append(time.perf_counter() - start)
+    return summarize(durations)
+
+
+def run(iterations: int, hash_iterations: int, users: int) -> dict:
+    import orjson
+    from app.security import hashing
+    from app.security.jwt_token import create_access_token, decode_access_token
+    from app.schemas.response_schemas import UserOutput
+    from app.utils.serializers import principal_dict
+
+    seed_users(users)
+    hashed = hashing.hash_password(PASSWORD)
+    token = create_access_token({'sub': user_email(1)})
+    principal = UserOutput(id=2, first_name='User1', last_name='Bench', email=user_email(1), bio='benchmark user')
+    slow = hash_iterations                                          # bcrypt runs are deliberately expensive
+
+    results = {
+        'hashing.hash_password': measure(lambda: hashing.hash_password(PASSWORD), slow),
+        'hashing.verify_password': measure(lambda: hashing.verify_password(PASSWORD, hashed), slow),
+        'jwt.create_access_token': measure(lambda: create_access_token({'sub': user_email(1)}), iterations),
+        'jwt.decode_access_token': measure(lambda: decode_access_token(token), iterations),
+        'UserOutput.model_dump_json': measure(principal.model_dump_json, iterations),
+        'UserOutput.orjson': measure(lambda: orjson.dumps(principal_dict(principal)), iterations),
+    }
+    results.update(asyncio.run(_run_async(iterations, slow, users, hashed)))
+    hashing.shutdown_executor()
+    return results
+
+
+async def _run_async(iterations: int, slow: int, users: int, hashed: str) -> dict:
+    from app.config.database import AsyncSessionLocal, async_engine
+    from app.repository.user_repository import UserRepository, SUPERUSER_FIELDS
+    from app.security import hashing
+
+    results = {
+        'hashing.verify_password_async': await measure_async(lambda: hashing.verify_password_async(PASSWORD, hashed), slow),
+    }
+    async with AsyncSessionLocal() as db:
+        repo = UserRepository(db)
+        middle = users // 2 or 1
+        queries = {
+            'UserRepository.get_user_by_email': lambda: repo.get_user_by_email(user_email(middle)),
+            'UserRepository.get_current_user': lambda: repo.get_current_user(user_email(middle)),
+            'UserRepository.get_user': lambda: repo.get_user(middle, super_user=False),
+            'UserRepository.get_user_version': lambda: repo.get_user_version(middle),
+            'UserRepository.users_page(50)': lambda: repo.users_page(list(SUPERUSER_FIELDS), True, 50, after_id=middle),
+        }
+        for name, query in queries.items():
+            results[name] = await measure_async(query, iterations)
+            db.expunge_all()
+    await async_engine.dispose()
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--iterations', type=int, default=500)
+    parser.add_argument('--hash-iterations', type=int, default=10)
+    parser.add_argument('--users', type=int, default=1000, help='synthetic users seeded before the repository benchmarks')
+    parser.add_argument('--database-url', default=f'sqlite:///{os.path.join(tempfile.gettempdir(), "profilely-bench.db")}',
+                        help='database to seed, it is dropped and recreated')
+    parser.add_argument('--output', help='JSON file for the results')
+    args = parser.parse_args()
+
+    configure(args.database_url)
+    results = run(args.iterations, args.hash_iterations, args.users)
+    print_table(results)
+    path = write_results('micro', {'iterations': args.iterations, 'hash_iterations': args.hash_iterations, 'users': args.users, 'database': args.database_url.split('://')[0]}, results, args.output)
+    print(f'\nresults written to {path}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,9 @@
 import pytest
+import socket
+import time
+from aiosmtpd.controller import Controller
+from settings import settings
+from app.utils.email_util import mailer
 from test_api import setup, teardown
 
 @pytest.fixture(scope="module", autouse=True)
@@ -6,3 +11,45 @@ def setup_and_teardown():
     setup()
     yield
     teardown()
+
+
+class SMTPSink:
+    '''Local SMTP server collecting every message the mailer delivers'''
+
+    def __init__(self):
+        self.messages = []
+        self.peers = []
+
+    async def handle_DATA(self, server, session, envelope):
+        self.messages.append(envelope)
+        self.peers.append(session.peer)                 # one peer address per client connection
+        return '250 Message accepted for delivery'
+
+    def wait_for(self, recipient: str, timeout: float = 5):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            for envelope in self.messages:
+                if recipient in envelope.rcpt_tos:
+                    return envelope
+            time.sleep(0.05)
+        raise AssertionError(f'no mail delivered to {recipient}')
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+@pytest.fixture(scope="session", autouse=True)
+def smtp_sink():
+    sink = SMTPSink()
+    controller = Controller(sink, hostname='127.0.0.1', port=free_port())
+    controller.start()
+    settings.MAIL_SERVER = controller.hostname
+    settings.MAIL_PORT = controller.port
+    settings.MAIL_STARTTLS = False
+    settings.MAIL_USE_CREDENTIALS = False
+    yield sink
+    mailer.stop()
+    controller.stop()
@@ -1,9 +1,17 @@
 from fastapi import FastAPI
-from fastapi.responses import RedirectResponse
+from fastapi.responses import RedirectResponse, JSONResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
-from app.router import user_router
-from app.utils.db_init import create_models
+from app.router import user_router, internal_router, metrics_router
+from app.utils.db_init import prepare_schema
+from app.utils import readiness
+from app.utils.activity import activity
+from app.config.database import async_engine, AsyncSessionLocal, replicas
+from app.utils.query_stats import QueryStatsMiddleware
+from app.utils.metrics import MetricsMiddleware
+from app.security import hashing
+from app.utils.email_util import mailer, templates
+from settings import settings
 
 description = """
 Profilely API helps you do awesome stuff. 🚀
@@ -13,6 +21,8 @@ Profilely API helps you do awesome stuff. 🚀
 * You can **create your profile** (_implemented_).
 * You can **verify your account using email verification link** (_implemented_).
 * You can **login to your account** (_implemented_).
+* You can **refresh your access token without sending your password again** (_implemented_).
+* You can **search profiles by name, email and bio** (_implemented_).
 * You can **update your profile** (_implemented_).
 * You can **reset your password** (_implemented_).
 * You can **forgot reset your password** (_implemented_).
@@ -22,7 +32,7 @@ Profilely API helps you do awesome stuff. 🚀
 
 
 app = FastAPI(
-    debug = True,
+    debug = settings.DEBUG,
     title = "Todo App",
     description = description,
     summary="User's favorite app for todos.",
@@ -42,11 +52,34 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+app.add_middleware(QueryStatsMiddleware)
+app.add_middleware(MetricsMiddleware)
+
 @app.on_event("startup")
-def on_startup()-> None:
-     create_models()
+async def on_startup()-> None:
+     prepare_schema(settings.DB_SCHEMA)
+     readiness.start_warm_up(async_engine, settings.DB_POOL_SIZE, [templates, user_router.templates.env])
+     activity.start(AsyncSessionLocal)
+     replicas.start()                               # health checks off the request path
+
+@app.on_event("shutdown")
+async def on_shutdown()-> None:
+     await activity.stop()                          # pending login history and last seen times
+     await replicas.stop()
+     hashing.shutdown_executor()
+     mailer.stop()
+
+@app.exception_handler(hashing.HashingBusy)
+def hashing_busy_handler(request, exc)-> JSONResponse:
+     return JSONResponse(
+          status_code=503,
+          content={'detail': 'server is busy, please retry shortly'},
+          headers={'Retry-After': '1'},
+     )
 
 app.include_router(user_router.router)
+app.include_router(internal_router.router)
+app.include_router(metrics_router.router)
 
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
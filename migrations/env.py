@@ -20,6 +20,7 @@ if config.config_file_name is not None:
 # target_metadata = mymodel.Base.metadata
 
 from app.models.user import Base
+from app.models import refresh_token, job, login_event
 
 target_metadata = Base.metadata
 
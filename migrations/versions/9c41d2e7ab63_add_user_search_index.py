@@ -0,0 +1,54 @@
+"""add user search index
+
+Revision ID: 9c41d2e7ab63
+Revises: 3b7e1c9a5d20
+Create Date: 2026-10-18 11:40:05.918344
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '9c41d2e7ab63'
+down_revision: Union[str, None] = '3b7e1c9a5d20'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+DOCUMENT = "to_tsvector('simple', coalesce(first_name, '') || ' ' || coalesce(last_name, '') || ' ' || coalesce(email, '') || ' ' || coalesce(bio, ''))"
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    if op.get_bind().dialect.name == 'postgresql':
+        op.execute(f'CREATE INDEX IF NOT EXISTS ix_users_search ON users USING gin ({DOCUMENT})')
+        return
+
+    op.execute("CREATE VIRTUAL TABLE users_fts USING fts5(first_name, last_name, email, bio, content='users', content_rowid='id')")
+    op.execute(
+        "CREATE TRIGGER users_fts_ai AFTER INSERT ON users BEGIN "
+        "INSERT INTO users_fts(rowid, first_name, last_name, email, bio) VALUES (new.id, new.first_name, new.last_name, new.email, new.bio); END"
+    )
+    op.execute(
+        "CREATE TRIGGER users_fts_ad AFTER DELETE ON users BEGIN "
+        "INSERT INTO users_fts(users_fts, rowid, first_name, last_name, email, bio) VALUES ('delete', old.id, old.first_name, old.last_name, old.email, old.bio); END"
+    )
+    op.execute(
+        "CREATE TRIGGER users_fts_au AFTER UPDATE OF first_name, last_name, email, bio ON users BEGIN "
+        "INSERT INTO users_fts(users_fts, rowid, first_name, last_name, email, bio) VALUES ('delete', old.id, old.first_name, old.last_name, old.email, old.bio); "
+        "INSERT INTO users_fts(rowid, first_name, last_name, email, bio) VALUES (new.id, new.first_name, new.last_name, new.email, new.bio); END"
+    )
+    op.execute("INSERT INTO users_fts(users_fts) VALUES ('rebuild')")     # index the existing users
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    if op.get_bind().dialect.name == 'postgresql':
+        op.execute('DROP INDEX IF EXISTS ix_users_search')
+        return
+
+    for trigger in ('users_fts_ai', 'users_fts_ad', 'users_fts_au'):
+        op.execute(f'DROP TRIGGER IF EXISTS {trigger}')
+    op.execute('DROP TABLE IF EXISTS users_fts')
@@ -0,0 +1,47 @@
+"""add login history
+
+Revision ID: d4a9c1e6f382
+Revises: 5e8f2a4c7d31
+Create Date: 2026-10-18 16:21:09.734518
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd4a9c1e6f382'
+down_revision: Union[str, None] = '5e8f2a4c7d31'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('users', sa.Column('last_login_at', sa.DateTime(), nullable=True))
+    op.add_column('users', sa.Column('last_seen_at', sa.DateTime(), nullable=True))
+    op.create_table('login_events',
+    sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=True),
+    sa.Column('email', sa.String(length=128), nullable=False),
+    sa.Column('succeeded', sa.Boolean(), nullable=False),
+    sa.Column('ip', sa.String(length=45), nullable=True),
+    sa.Column('user_agent', sa.String(length=256), nullable=True),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_login_events_created_at'), 'login_events', ['created_at'], unique=False)
+    op.create_index(op.f('ix_login_events_email'), 'login_events', ['email'], unique=False)
+    op.create_index(op.f('ix_login_events_user_id'), 'login_events', ['user_id'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index(op.f('ix_login_events_user_id'), table_name='login_events')
+    op.drop_index(op.f('ix_login_events_email'), table_name='login_events')
+    op.drop_index(op.f('ix_login_events_created_at'), table_name='login_events')
+    op.drop_table('login_events')
+    op.drop_column('users', 'last_seen_at')
+    op.drop_column('users', 'last_login_at')
@@ -0,0 +1,56 @@
+'''Production entry point: python server.py
+
+Checks the schema once, then serves main:app with one uvicorn worker per core and no autoreload.
+'''
+
+import os
+
+MIN_HASHING_POOL = 2
+
+
+def cpu_count() -> int:
+    try:
+        return len(os.sched_getaffinity(0))         # respects container CPU pinning
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def shared_response_cache(workers: int) -> None:
+    '''With several workers the response cache generations must be shared, a memory backend would serve what another worker invalidated'''
+
+    if workers <= 1:
+        return
+    backend = os.environ.setdefault('RESPONSE_CACHE_BACKEND', 'app.utils.response_cache.SQLiteCacheBackend')
+    if backend.endswith('.MemoryCacheBackend'):
+        raise SystemExit(f'RESPONSE_CACHE_BACKEND={backend} is only correct with one worker, use SQLiteCacheBackend or KVCacheBackend')
+
+
+def main() -> None:
+    cores = cpu_count()
+    os.environ.setdefault('DB_SCHEMA', 'check')
+
+    from settings import settings
+    from app.utils.db_init import prepare_schema
+
+    workers = settings.WEB_CONCURRENCY or cores
+    prepare_schema(settings.DB_SCHEMA)              # once here instead of in every worker
+    os.environ['DB_SCHEMA'] = 'skip'
+    # every worker owns a hashing pool, share the cores between them instead of spawning cores * workers processes;
+    # two at least, so a bulk import (at most pool - 1 processes) always leaves one for logins
+    os.environ.setdefault('HASHING_POOL_SIZE', str(max(MIN_HASHING_POOL, cores // workers)))
+    shared_response_cache(workers)
+
+    import uvicorn
+    uvicorn.run(
+        'main:app',
+        host=settings.HOST,
+        port=settings.PORT,
+        workers=workers,
+        reload=False,
+        proxy_headers=True,
+        log_level='debug' if settings.DEBUG else 'info',
+    )
+
+
+if __name__ == '__main__':
+    main()
@@ -6,11 +6,73 @@ load_dotenv()
 
 class Settings:
     def __init__(self):
+        self.DEBUG = os.getenv('DEBUG', 'false').lower() in ('1', 'true', 'yes')
+        self.QUERY_STATS_HEADERS = os.getenv('QUERY_STATS_HEADERS', str(self.DEBUG)).lower() in ('1', 'true', 'yes')   # X-DB-Query-* response headers
+        self.HOST = os.getenv('HOST', '0.0.0.0')
+        self.PORT = int(os.getenv('PORT', 8000))
+        self.WEB_CONCURRENCY = int(os.getenv('WEB_CONCURRENCY', 0))                # server.py workers, 0 means one per core
+        self.INTERNAL_TOKEN = os.getenv('INTERNAL_TOKEN', '')                   # bearer token of /internal/db-pool and /metrics, unset hides them
+        self.DB_SCHEMA = os.getenv('DB_SCHEMA', 'create')                         # startup schema handling: create, check or skip
         self.DATABASE = os.getenv('DATABASE_URL')
+        self.ASYNC_DATABASE = os.getenv('ASYNC_DATABASE_URL')         # derived from DATABASE_URL when unset
+        self.DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 5))
+        self.DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', 10))
+        self.DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', 30))
+        self.DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', 1800))            # seconds, -1 disables recycling
+        self.DATABASE_REPLICA_URLS = [url.strip() for url in os.getenv('DATABASE_REPLICA_URLS', '').split(',') if url.strip()]
+        self.DB_REPLICA_CHECK_INTERVAL = float(os.getenv('DB_REPLICA_CHECK_INTERVAL', 5))      # seconds between health checks
+        self.DB_REPLICA_CHECK_TIMEOUT = float(os.getenv('DB_REPLICA_CHECK_TIMEOUT', 1))
+        self.READ_YOUR_WRITES_SECONDS = float(os.getenv('READ_YOUR_WRITES_SECONDS', 5))       # reads stay on the primary after a write
+        self.DB_POOL_PRE_PING = os.getenv('DB_POOL_PRE_PING', 'true').lower() in ('1', 'true', 'yes')
         self.MAIL_USERNAME = os.getenv('MAIL_USERNAME')
         self.MAIL_PASSWORD = os.getenv('MAIL_PASSWORD')
-        self.MAIL_PORT=587
-        self.MAIL_SERVER= 'smtp.gmail.com'
+        self.SECRET_KEY = os.getenv('SECRET_KEY')
+        self.MAIL_FROM = os.getenv('MAIL_FROM', self.MAIL_USERNAME)
+        self.MAIL_PORT = int(os.getenv('MAIL_PORT', 587))
+        self.MAIL_SERVER = os.getenv('MAIL_SERVER', 'smtp.gmail.com')
+        self.MAIL_STARTTLS = os.getenv('MAIL_STARTTLS', 'true').lower() in ('1', 'true', 'yes')
+        self.MAIL_SSL_TLS = os.getenv('MAIL_SSL_TLS', 'false').lower() in ('1', 'true', 'yes')
+        self.MAIL_USE_CREDENTIALS = os.getenv('MAIL_USE_CREDENTIALS', 'true').lower() in ('1', 'true', 'yes')
+        self.MAIL_POOL_SIZE = int(os.getenv('MAIL_POOL_SIZE', 2))                # persistent SMTP connections
+        self.MAIL_BATCH_SIZE = int(os.getenv('MAIL_BATCH_SIZE', 20))              # messages sent per connection wake up
+        self.MAIL_IDLE_TIMEOUT = float(os.getenv('MAIL_IDLE_TIMEOUT', 60))
+        self.JOB_WORKER_CONCURRENCY = int(os.getenv('JOB_WORKER_CONCURRENCY', 8))      # jobs one worker.py process runs at a time
+        self.JOB_POLL_INTERVAL = float(os.getenv('JOB_POLL_INTERVAL', 1))              # seconds between polls of a drained queue
+        self.JOB_LEASE_SECONDS = float(os.getenv('JOB_LEASE_SECONDS', 60))             # a job running longer is failed and retried
+        self.JOB_MAX_ATTEMPTS = int(os.getenv('JOB_MAX_ATTEMPTS', 5))                  # then the job is dead lettered
+        self.JOB_BACKOFF_BASE = float(os.getenv('JOB_BACKOFF_BASE', 5))
+        self.JOB_BACKOFF_MAX = float(os.getenv('JOB_BACKOFF_MAX', 900))
+        self.ACTIVITY_FLUSH_INTERVAL = float(os.getenv('ACTIVITY_FLUSH_INTERVAL', 5))  # seconds login history and last seen stay buffered
+        self.ACTIVITY_FLUSH_SIZE = int(os.getenv('ACTIVITY_FLUSH_SIZE', 500))           # pending login events that force an early flush
+        self.PRINCIPAL_CACHE_SIZE = int(os.getenv('PRINCIPAL_CACHE_SIZE', 10000))
+        self.PRINCIPAL_CACHE_TTL = float(os.getenv('PRINCIPAL_CACHE_TTL', 60))
+        self.RESPONSE_CACHE_BACKEND = os.getenv('RESPONSE_CACHE_BACKEND', 'app.utils.response_cache.MemoryCacheBackend')
+        self.RESPONSE_CACHE_TTL = float(os.getenv('RESPONSE_CACHE_TTL', 300))
+        self.RESPONSE_CACHE_SIZE = int(os.getenv('RESPONSE_CACHE_SIZE', 10000))
+        self.RESPONSE_CACHE_KV_URL = os.getenv('RESPONSE_CACHE_KV_URL', '')                 # e.g. redis://localhost:6379/0
+        self.TOKEN_CACHE_SIZE = int(os.getenv('TOKEN_CACHE_SIZE', 10000))          # verified bearer tokens, 0 disables
+        self.PASSWORD_SCHEMES = [scheme.strip() for scheme in os.getenv('PASSWORD_SCHEMES', 'bcrypt').split(',')]   # first one hashes new passwords
+        self.BCRYPT_ROUNDS = int(os.getenv('BCRYPT_ROUNDS', 12))
+        self.ARGON2_TIME_COST = int(os.getenv('ARGON2_TIME_COST', 3))                 # argon2 needs argon2-cffi installed
+        self.ARGON2_MEMORY_COST = int(os.getenv('ARGON2_MEMORY_COST', 65536))         # KiB
+        self.ARGON2_PARALLELISM = int(os.getenv('ARGON2_PARALLELISM', 4))
+        self.HASHING_POOL_SIZE = int(os.getenv('HASHING_POOL_SIZE', max(2, os.cpu_count() or 1)))
+        self.HASHING_QUEUE_DEPTH = int(os.getenv('HASHING_QUEUE_DEPTH', 64))
+        self.HASHING_BATCH_CHUNK = int(os.getenv('HASHING_BATCH_CHUNK', 8))          # passwords per pool job of a bulk import
+        self.HASHING_BATCH_WORKERS = int(os.getenv('HASHING_BATCH_WORKERS', max(1, self.HASHING_POOL_SIZE // 2)))   # pool processes an import may occupy
+        self.PAGE_DEFAULT_LIMIT = int(os.getenv('PAGE_DEFAULT_LIMIT', 50))
+        self.PAGE_MAX_LIMIT = int(os.getenv('PAGE_MAX_LIMIT', 500))
+        self.BATCH_MAX_IDS = int(os.getenv('BATCH_MAX_IDS', 100))
+        self.SEARCH_MAX_TERMS = int(os.getenv('SEARCH_MAX_TERMS', 8))
+        self.EXPORT_BATCH_SIZE = int(os.getenv('EXPORT_BATCH_SIZE', 1000))
+        self.IMPORT_BATCH_SIZE = int(os.getenv('IMPORT_BATCH_SIZE', 1000))
+        self.RATE_LIMIT_STORE = os.getenv('RATE_LIMIT_STORE', 'app.security.rate_limit.MemoryRateLimitStore')
+        self.RATE_LIMIT_IP_PER_MINUTE = float(os.getenv('RATE_LIMIT_IP_PER_MINUTE', 60))
+        self.RATE_LIMIT_ACCOUNT_PER_MINUTE = float(os.getenv('RATE_LIMIT_ACCOUNT_PER_MINUTE', 10))
+        self.RATE_LIMIT_BURST = float(os.getenv('RATE_LIMIT_BURST', 10))
+        self.RATE_LIMIT_STORE_TIMEOUT = float(os.getenv('RATE_LIMIT_STORE_TIMEOUT', 0.25))      # past it the request is admitted
+        self.VERIFY_LINK_EXPIRE_MINUTES = int(os.getenv('VERIFY_LINK_EXPIRE_MINUTES', 60 * 24))
+        self.RESET_LINK_EXPIRE_MINUTES = int(os.getenv('RESET_LINK_EXPIRE_MINUTES', 30))
 
 
 settings = Settings()
@@ -1,12 +1,43 @@
 from fastapi.testclient import TestClient
-from app.config.database import get_db
+from app.config.database import get_db, get_sessionmaker
 from main import app
-from sqlalchemy import create_engine, StaticPool, text
+from sqlalchemy import create_engine, StaticPool, NullPool, text
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from app.models.user import Base, User
-from app.security import hashing
+from app.schemas.response_schemas import UserOutput
+from app.security import hashing, signed_token, encode_decode
+from settings import settings
+import asyncio
+import json
+import os
+import sqlite3
+import pytest
+from datetime import timedelta
+import time
+from app.utils.email_util import send_email_background
+from app.utils.cache import principal_cache
+from app.utils.query_stats import track_queries, COUNT_HEADER, BUDGET_HEADER
+from app.repository.user_repository import UserRepository
+from app.utils.pool_stats import TimedQueuePool, pool_status
+from app.security.rate_limit import MemoryRateLimitStore
+from app.security import rate_limit
+from unittest.mock import patch
+from app.security import jwt_token
+from app.security.jwt_token import create_access_token, decode_access_token, evict_tokens
+from app.utils.cache import token_cache
+from app.config.database import ReplicaSet, get_replica_set
+from app.utils.response_cache import response_cache, WRITER_KEY, ResponseCache, CacheBackend, MemoryCacheBackend, SQLiteCacheBackend, KVCacheBackend
+from app.utils import readiness
+from app.utils.email_util import templates as email_templates
+from app.utils.db_init import SchemaOutOfDate, check_schema, migration_head
+from app.utils import job_queue
+from app.models.job import Job
+from app.models.login_event import LoginEvent
+from app.utils.activity import ActivityBuffer, activity
 
 DATABASE_URL = "sqlite:///:memory"
+ASYNC_DATABASE_URL = "sqlite+aiosqlite:///:memory"
 
 engine = create_engine(
     DATABASE_URL,
@@ -16,23 +47,42 @@ engine = create_engine(
     poolclass=StaticPool,
 )
 
-TestingSessionLocal = sessionmaker(autocommit = False, autoflush=False, bind=engine)
+TestingSessionLocal = sessionmaker(autocommit = False, autoflush=False, expire_on_commit=False, bind=engine)
 
-def override_get_db():
-    db = TestingSessionLocal()
-    try:
-        yield db
+# every TestClient request runs on a fresh event loop, so async connections are not pooled
+async_engine = create_async_engine(ASYNC_DATABASE_URL, poolclass=NullPool)
 
-    finally:
-        db.close()
+AsyncTestingSessionLocal = async_sessionmaker(autoflush=False, expire_on_commit=False, bind=async_engine)
+
+async def override_get_db():
+    async with AsyncTestingSessionLocal() as db:
+        yield db
 
 app.dependency_overrides[get_db] = override_get_db
+app.dependency_overrides[get_sessionmaker] = lambda: AsyncTestingSessionLocal
+
+def check_query_budget(response):
+    # every route declares a query budget, fail the test as soon as one is exceeded
+    if BUDGET_HEADER in response.headers:
+        assert int(response.headers[COUNT_HEADER]) <= int(response.headers[BUDGET_HEADER]), response.request.url
 
+settings.QUERY_STATS_HEADERS = True                 # the budget checks read them
 client = TestClient(app)
+client.event_hooks['response'] = [check_query_budget]
 
 auth_token = None # For JWT token
 
 
+def run_jobs() -> int:
+    # what worker.py does, one batch at a time
+    return asyncio.run(job_queue.Worker(AsyncTestingSessionLocal, 4, 0.1, 5).run_once())
+
+
+def forget_writers() -> int:
+    # the read-your-writes markers live in the response cache backend, MemoryCacheBackend in the tests
+    return response_cache.backend._entries.invalidate_where(lambda key, _: key.startswith(WRITER_KEY.format('')))
+
+
 def setup():
     print("Setting up the database...")
     
@@ -107,7 +157,7 @@ def test_already_exist_user():
     assert response.json() == {'detail': 'user with same email already registered'}
 
 
-def test_user_create():
+def test_user_create(smtp_sink):
     response = client.post("/user/", json={
         "bio": "Football, Tennis, Foosball",
         "email": "ashishchaudhary9193@gmail.com",
@@ -117,6 +167,9 @@ def test_user_create():
         })
     assert response.status_code == 201
     assert response.json() == {'success': 'profile created, a verification link has been send to your registered email'}
+    assert run_jobs() >= 1
+    envelope = smtp_sink.wait_for('ashishchaudhary9193@gmail.com')
+    assert b'/user/verify?token=' in envelope.content
 
 def test_user_login():
     response = client.post("/user/login", data={
@@ -157,13 +210,591 @@ def test_invalid_token():
     assert response.status_code == 401
     assert response.json() == {'detail': 'Could not validate credentials'}
 
+def test_principal_cache_invalidated_on_update():
+    headers = {'Authorization': f'Bearer {auth_token}'}
+    response = client.get('/user/me', headers=headers)
+    assert response.status_code == 200
+    assert 'chauashish21@gmail.com' in principal_cache
+
+    response = client.patch('/user/', json={'bio': 'Chess'}, headers=headers)
+    assert response.status_code == 204
+    assert 'chauashish21@gmail.com' not in principal_cache
+    assert client.get('/user/me', headers=headers).json()['bio'] == 'Chess'
+
+    client.patch('/user/', json={'bio': 'Foosball'}, headers=headers)
+    assert client.get('/user/me', headers=headers).json()['bio'] == 'Foosball'
+
+def test_warm_principal_cache_skips_database():
+    response = client.get('/user/me', headers={'Authorization': f'Bearer {auth_token}'})
+    assert response.status_code == 200
+    assert response.headers[COUNT_HEADER] == '0'
+
+def test_principal_cache_follows_writes_on_other_workers():
+    headers = {'Authorization': f'Bearer {auth_token}'}
+    assert client.get('/user/me', headers=headers).headers[COUNT_HEADER] == '0'
+    asyncio.run(response_cache.bump(email='chauashish21@gmail.com'))       # what a write served by another worker does
+    assert 'chauashish21@gmail.com' in principal_cache
+    assert client.get('/user/me', headers=headers).headers[COUNT_HEADER] != '0'
+    assert client.get('/user/me', headers=headers).headers[COUNT_HEADER] == '0'
+
+def test_query_stats_headers_off_by_default(monkeypatch):
+    monkeypatch.setattr(settings, 'QUERY_STATS_HEADERS', False)
+    response = client.get('/user/me', headers={'Authorization': f'Bearer {auth_token}'})
+    assert response.status_code == 200
+    assert COUNT_HEADER not in response.headers and BUDGET_HEADER not in response.headers
+
+def test_repository_single_round_trip():
+    async def get_user():
+        async with AsyncTestingSessionLocal() as session:
+            with track_queries(budget=1) as stats:
+                user = await UserRepository(session).get_user(1, super_user=True)
+        return user, stats
+
+    user, stats = asyncio.run(get_user())
+    assert user.email == 'chauashish21@gmail.com'
+    assert stats.count == 1
+
+def test_async_hashing_uses_process_pool():
+    hashed = asyncio.run(hashing.hash_password_async('hello123@dinoPG'))
+    assert asyncio.run(hashing.verify_password_async('hello123@dinoPG', hashed))
+    assert not asyncio.run(hashing.verify_password_async('wrongpassword', hashed))
+
+def test_batch_hashing_leaves_pool_slots_free(monkeypatch):
+    monkeypatch.setattr(settings, 'HASHING_BATCH_CHUNK', 2)
+    monkeypatch.setattr(settings, 'HASHING_BATCH_WORKERS', 2)
+    monkeypatch.setattr(settings, 'HASHING_POOL_SIZE', 4)
+    running, peak, chunks = 0, 0, []
+    async def fake_pool(func, passwords):
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+        chunks.append(len(passwords))
+        return [f'hashed-{password}' for password in passwords]
+    monkeypatch.setattr(hashing, '_run_in_pool', fake_pool)
+    passwords = [f'password{i}' for i in range(9)]
+    assert asyncio.run(hashing.hash_passwords_async(passwords)) == [f'hashed-{password}' for password in passwords]
+    assert peak == 2 and sorted(chunks) == [1, 2, 2, 2, 2]
+
+    monkeypatch.setattr(settings, 'HASHING_POOL_SIZE', 2)                  # one process is always left for logins
+    peak = 0
+    asyncio.run(hashing.hash_passwords_async(passwords))
+    assert peak == 1
+
+def test_hashing_queue_full(monkeypatch):
+    monkeypatch.setattr(settings, 'HASHING_QUEUE_DEPTH', -settings.HASHING_POOL_SIZE)
+    response = client.post("/user/login", data={
+        'username':'chauashish21@gmail.com',
+        'password' : 'hello123@dinoPG'
+    })
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '1'
+
+def test_signed_token():
+    token = signed_token.create_token('premmehra@gmail.com', signed_token.RESET_PASSWORD, 'v1', 60)
+    assert signed_token.read_token(token, signed_token.RESET_PASSWORD)['sub'] == 'premmehra@gmail.com'
+    for purpose, tampered in [(signed_token.VERIFY_ACCOUNT, token), (signed_token.RESET_PASSWORD, token[:-2] + 'AA')]:
+        try:
+            signed_token.read_token(tampered, purpose)
+            assert False, 'token should be rejected'
+        except signed_token.InvalidSignedToken:
+            pass
+
+def test_reset_link_is_single_use():
+    session = TestingSessionLocal()
+    user = session.query(User).filter(User.email == 'premmehra@gmail.com').first()
+    session.close()
+    form = {
+        'token': signed_token.create_token(user.email, signed_token.RESET_PASSWORD, user.get_context(), 60),
+        'data': encode_decode.encode_data(user.email),
+        'new_password': 'hello123@dinoPG',
+    }
+    response = client.post('/user/reset-forgot-password', data=form)
+    assert response.status_code == 200
+    response = client.post('/user/reset-forgot-password', data=form)
+    assert response.status_code == 400
+
+def test_expired_link_rejected_without_database():
+    token = signed_token.create_token('premmehra@gmail.com', signed_token.VERIFY_ACCOUNT, 'v1', -1)
+    response = client.get('/user/verify', params={'token': token, 'data': encode_decode.encode_data('premmehra@gmail.com')})
+    assert response.status_code == 400
+    assert response.headers[COUNT_HEADER] == '0'
+
+def test_pool_wait_statistics(monkeypatch):
+    pool_engine = create_engine(DATABASE_URL, poolclass=TimedQueuePool, pool_size=1, max_overflow=0)
+    with pool_engine.connect():
+        status = pool_status(pool_engine)
+    assert status['checked_out'] == 1
+    assert status['checkouts'] == 1
+    assert pool_status(pool_engine)['idle'] == 1
+    pool_engine.dispose()
+
+    assert client.get('/internal/db-pool').status_code == 404              # no INTERNAL_TOKEN configured
+    monkeypatch.setattr(settings, 'INTERNAL_TOKEN', 'ops-secret')
+    assert client.get('/internal/db-pool', headers={'Authorization': 'Bearer wrong'}).status_code == 401
+    response = client.get('/internal/db-pool', headers={'Authorization': 'Bearer ops-secret'})
+    assert response.status_code == 200
+    assert 'async' in response.json()
+
+def test_all_users_keyset_pagination():
+    headers = {'Authorization': f'Bearer {auth_token}'}
+    response = client.get('/user/all', params={'limit': 1}, headers=headers)
+    assert response.status_code == 200
+    page = response.json()
+    assert len(page['items']) == 1
+    assert page['items'][0]['fullname'] == 'Ashish Chaudhary'
+
+    response = client.get('/user/all', params={'limit': 1, 'cursor': page['next_cursor'], 'fields': 'email'}, headers=headers)
+    assert response.json()['items'] == [{'email': 'premmehra@gmail.com'}]
+
+def test_all_users_unknown_field():
+    response = client.get('/user/all', params={'fields': 'password'}, headers={'Authorization': f'Bearer {auth_token}'})
+    assert response.status_code == 400
+
+def test_export_users_streams_ndjson_and_csv():
+    headers = {'Authorization': f'Bearer {auth_token}'}
+    response = client.get('/user/export', headers=headers)
+    assert response.status_code == 200
+    assert response.headers['content-type'] == 'application/x-ndjson'
+    rows = [json.loads(line) for line in response.text.splitlines()]
+    assert rows[0]['email'] == 'chauashish21@gmail.com'
+    assert 'password' not in rows[0]
+
+    response = client.get('/user/export', params={'format': 'csv'}, headers=headers)
+    lines = response.text.splitlines()
+    assert lines[0] == 'id,first_name,last_name,email,is_superuser,bio,created_at'
+    assert len(lines) == len(rows) + 1
+
+def test_bulk_import_users():
+    upload = (
+        'first_name,last_name,email,password,bio\r\n'
+        'Riya,Sen,riyasen@gmail.com,hello123@dinoPG,Chess\r\n'
+        'Prem,Mehra,premmehra@gmail.com,hello123@dinoPG,\r\n'
+        'Weak,Password,weak@gmail.com,hello,\r\n'
+        'Riya,Sen,riyasen@gmail.com,hello123@dinoPG,Chess\r\n'
+    )
+    forget_writers()
+    response = client.post('/user/import', content=upload, headers={'Authorization': f'Bearer {auth_token}', 'Content-Type': 'text/csv'})
+    assert response.status_code == 200
+    report = response.json()
+    assert report['created'] == 1
+    assert asyncio.run(response_cache.wrote_recently('chauashish21@gmail.com'))
+    assert [result['status'] for result in report['results']] == ['created', 'duplicate', 'invalid', 'duplicate']
+
+    response = client.post('/user/login', data={'username': 'riyasen@gmail.com', 'password': 'hello123@dinoPG'})
+    assert response.status_code == 200
+
+def test_bulk_import_json_lines():
+    upload = '{"first_name": "Kabir", "last_name": "Das", "email": "kabirdas@gmail.com", "password": "hello123@dinoPG"}\nnot json\n'
+    response = client.post('/user/import', content=upload, headers={'Authorization': f'Bearer {auth_token}', 'Content-Type': 'application/x-ndjson'})
+    assert [result['status'] for result in response.json()['results']] == ['created', 'invalid']
+
+def test_bulk_import_reports_malformed_rows(monkeypatch):
+    headers = {'Authorization': f'Bearer {auth_token}'}
+    response = client.post('/user/import', content=b'\xff\xfe\x00bad', headers={**headers, 'Content-Type': 'text/csv'})
+    assert response.status_code == 200
+    assert [result['status'] for result in response.json()['results']] == ['invalid']
+
+    upload = 'first_name,last_name,email,password\r\nToo,Many,toomany@gmail.com,hello123@dinoPG,extra\r\n'
+    response = client.post('/user/import', content=upload, headers={**headers, 'Content-Type': 'text/csv'})
+    assert response.json()['results'][0]['detail'] == 'more fields than the header'
+
+    upload = '{"first_name": "Int", "last_name": "Pass", "email": "intpass@gmail.com", "password": 12345678}\n'
+    response = client.post('/user/import', content=upload, headers={**headers, 'Content-Type': 'application/x-ndjson'})
+    assert response.status_code == 200
+    assert response.json()['results'][0]['status'] == 'invalid'
+
+    async def busy(passwords):
+        raise hashing.HashingBusy()
+    monkeypatch.setattr(hashing, 'hash_passwords_async', busy)
+    upload = '{"first_name": "Busy", "last_name": "Pool", "email": "busypool@gmail.com", "password": "hello123@dinoPG"}\n'
+    response = client.post('/user/import', content=upload, headers={**headers, 'Content-Type': 'application/x-ndjson'})
+    assert response.status_code == 200
+    assert response.json()['results'] == [{'row': 1, 'email': 'busypool@gmail.com', 'status': 'error', 'detail': 'server busy, retry this row'}]
+
+def test_bulk_import_all_duplicates_skips_insert(monkeypatch):
+    async def no_insert(self, users, writer):
+        raise AssertionError('nothing to insert')
+    monkeypatch.setattr(UserRepository, 'bulk_create', no_insert)
+    upload = '{"first_name": "Kabir", "last_name": "Das", "email": "kabirdas@gmail.com", "password": "hello123@dinoPG"}\n'
+    response = client.post('/user/import', content=upload, headers={'Authorization': f'Bearer {auth_token}', 'Content-Type': 'application/x-ndjson'})
+    assert response.json()['results'] == [{'row': 1, 'email': 'kabirdas@gmail.com', 'status': 'duplicate', 'detail': 'already registered'}]
+
+def test_fast_path_matches_response_model():
+    response = client.get('/user/2', headers={'Authorization': f'Bearer {auth_token}'})
+    assert response.status_code == 200
+    expected = UserOutput(**response.json()).model_dump(mode='json', exclude_none=True)
+    assert response.json() == expected
+    assert response.json()['fullname'] == 'Prem Mehra'
+    assert 'created_at' in response.json()
+
+def test_fast_path_masks_fields_for_regular_users():
+    token = client.post('/user/login', data={'username': 'premmehra@gmail.com', 'password': 'hello123@dinoPG'}).json()['access_token']
+    headers = {'Authorization': f'Bearer {token}'}
+    assert set(client.get('/user/1', headers=headers).json()) == {'first_name', 'last_name', 'email', 'bio', 'fullname'}
+    me = client.get('/user/me', headers=headers).json()
+    assert 'is_superuser' not in me and 'created_at' not in me
+
+def test_conditional_get_returns_304():
+    forget_writers()                                      # the principal's own recent writes bypass the response cache
+    headers = {'Authorization': f'Bearer {auth_token}'}
+    response = client.get('/user/2', headers=headers)
+    etag = response.headers['ETag']
+    response = client.get('/user/2', headers={**headers, 'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.content == b''
+    assert response.headers[COUNT_HEADER] == '0'                # ETag from the response cache, principal is cached
+
+    etag = client.get('/user/me', headers=headers).headers['ETag']
+    response = client.get('/user/me', headers={**headers, 'If-None-Match': etag})
+    assert response.status_code == 304
+    client.patch('/user/', json={'bio': 'Foosball'}, headers=headers)
+    assert client.get('/user/me', headers={**headers, 'If-None-Match': etag}).status_code == 200
+
+def test_login_rate_limited_per_account(monkeypatch):
+    monkeypatch.setattr(settings, 'RATE_LIMIT_BURST', 2)
+    monkeypatch.setattr(settings, 'RATE_LIMIT_ACCOUNT_PER_MINUTE', 1)
+    credentials = {'username': 'stuffing-target@gmail.com', 'password': 'wrongpassword'}
+    assert [client.post('/user/login', data=credentials).status_code for _ in range(2)] == [401, 401]
+    response = client.post('/user/login', data=credentials)
+    assert response.status_code == 429
+    assert int(response.headers['Retry-After']) > 0
+    assert response.headers[COUNT_HEADER] == '0'
+
+def test_rate_limit_store_must_implement_hit():
+    class Incomplete(rate_limit.RateLimitStore):
+        pass
+    with pytest.raises(TypeError):
+        Incomplete()
+
+def test_token_bucket_refills():
+    store = MemoryRateLimitStore()
+    assert store.hit('k', rate=1000, capacity=1) == 0
+    assert store.hit('k', rate=1000, capacity=1) > 0
+    time.sleep(0.01)
+    assert store.hit('k', rate=1000, capacity=1) == 0
+
+def test_sqlite_rate_limit_prunes_full_buckets(tmp_path, monkeypatch):
+    monkeypatch.setattr(rate_limit.SQLiteRateLimitStore, 'PRUNE_EVERY', 3)
+    store = rate_limit.SQLiteRateLimitStore(str(tmp_path / 'buckets.sqlite'))
+    assert store.hit('refilled', rate=1000, capacity=1) == 0
+    time.sleep(0.01)
+    assert store.hit('empty', rate=0.001, capacity=1) == 0
+    assert store.hit('empty', rate=0.001, capacity=1) > 0
+    assert store._connection().execute('SELECT key FROM token_buckets').fetchall() == [('empty',)]
+
+def test_rate_limit_fails_open(monkeypatch):
+    class Locked(rate_limit.RateLimitStore):
+        def hit(self, key, rate, capacity):
+            raise sqlite3.OperationalError('database is locked')
+    monkeypatch.setattr(rate_limit, 'store', Locked())
+    response = client.post('/user/login', data={'username': 'premmehra@gmail.com', 'password': 'hello123@dinoPG'})
+    assert response.status_code == 200
+
+def test_metrics_endpoint(monkeypatch):
+    client.get('/user/1', headers={'Authorization': f'Bearer {auth_token}'})
+    monkeypatch.setattr(settings, 'INTERNAL_TOKEN', 'ops-secret')
+    assert client.get('/metrics').status_code == 401
+    response = client.get('/metrics', headers={'Authorization': 'Bearer ops-secret'})
+    assert response.status_code == 200
+    assert response.headers['content-type'].startswith('text/plain')
+    assert 'http_requests_total{method="GET",route="/user/{user_id}",status="200"}' in response.text
+    assert 'db_statement_duration_seconds_count{operation="SELECT"}' in response.text
+    assert 'hashing_duration_seconds_count{operation="verify_password"}' in response.text
+
+def test_token_without_expiry_rejected():
+    token = jwt_token.jwt.encode({'sub': 'chauashish21@gmail.com'}, jwt_token.SECRET_KEY, algorithm=jwt_token.ALGORITHM)
+    response = client.get('/user/me', headers={'Authorization': f'Bearer {token}'})
+    assert response.status_code == 401
+
+def test_verified_token_cache(monkeypatch):
+    token = create_access_token({'sub': 'cached@gmail.com'}, expires_delta=timedelta(minutes=5))
+    assert decode_access_token(token).user_email == 'cached@gmail.com'
+    monkeypatch.setattr(jwt_token.jwt, 'decode', lambda *args, **kwargs: pytest.fail('token verified twice'))
+    assert decode_access_token(token).user_email == 'cached@gmail.com'
+    assert evict_tokens('cached@gmail.com') == 1
+    assert token not in token_cache
+
+def test_refresh_token_rotation_and_reuse(monkeypatch):
+    monkeypatch.setattr(rate_limit, 'store', MemoryRateLimitStore())
+    tokens = client.post('/user/login', data={'username': 'premmehra@gmail.com', 'password': 'hello123@dinoPG'}).json()
+    assert tokens['refresh_token']
+
+    with patch.object(hashing, 'verify_password_async', side_effect=AssertionError('password re-checked')):
+        response = client.post('/user/token/refresh', json={'refresh_token': tokens['refresh_token']})
+    assert response.status_code == 200
+    rotated = response.json()
+    assert rotated['refresh_token'] != tokens['refresh_token']
+    assert client.get('/user/me', headers={'Authorization': f"Bearer {rotated['access_token']}"}).status_code == 200
+
+    # replaying the rotated token revokes the whole login, including its successor
+    assert client.post('/user/token/refresh', json={'refresh_token': tokens['refresh_token']}).status_code == 401
+    assert client.post('/user/token/refresh', json={'refresh_token': rotated['refresh_token']}).status_code == 401
+
+def test_search_users_ranked_and_paged():
+    headers = {'Authorization': f'Bearer {auth_token}'}
+    response = client.get('/user/search', params={'q': 'foos'}, headers=headers)
+    assert response.status_code == 200
+    emails = [item['email'] for item in response.json()['items']]
+    assert {'chauashish21@gmail.com', 'premmehra@gmail.com'} <= set(emails)
+
+    response = client.get('/user/search', params={'q': 'prem MEH'}, headers=headers)
+    assert [item['email'] for item in response.json()['items']] == ['premmehra@gmail.com']
+
+    pages, cursor = [], None
+    while True:
+        page = client.get('/user/search', params={'q': 'foos', 'limit': 1, 'cursor': cursor}, headers=headers).json()
+        pages += [item['email'] for item in page['items']]
+        cursor = page['next_cursor']
+        if cursor is None:
+            break
+    assert pages == emails
+
+def test_search_users_invalid_query():
+    headers = {'Authorization': f'Bearer {auth_token}'}
+    assert client.get('/user/search', params={'q': '***'}, headers=headers).status_code == 400
+    assert client.get('/user/search', params={'q': 'foos', 'cursor': 'bogus'}, headers=headers).status_code == 400
+
+def test_ready_after_warm_up():
+    asyncio.run(readiness.warm_up(async_engine, 1, [email_templates]))
+    assert client.get('/internal/ready').json() == {'status': 'ready'}
+
+def test_schema_check_requires_migration_head():
+    with pytest.raises(SchemaOutOfDate):
+        check_schema()                                  # the test database is built with create_all
+    assert any(name.startswith(migration_head()) for name in os.listdir('migrations/versions'))
+
+def replica_sessionmaker(url):
+    return async_sessionmaker(bind=create_async_engine(url, poolclass=NullPool), autoflush=False, expire_on_commit=False)
+
+def test_reads_routed_to_replica(tmp_path, monkeypatch):
+    replica = create_engine(f'sqlite:///{tmp_path}/replica.db')
+    Base.metadata.create_all(bind=replica)
+    with engine.connect() as primary, replica.begin() as connection:
+        for row in primary.execute(User.__table__.select()).mappings():
+            connection.execute(User.__table__.insert().values({**row, 'bio': 'from replica'}))
+    replica.dispose()
+
+    replica_set = ReplicaSet([replica_sessionmaker(f'sqlite+aiosqlite:///{tmp_path}/replica.db')], check_interval=60, check_timeout=1)
+    monkeypatch.setitem(app.dependency_overrides, get_replica_set, lambda: replica_set)
+    forget_writers()
+    principal_cache.clear()
+    asyncio.run(response_cache.bump(2))
+    headers = {'Authorization': f'Bearer {auth_token}'}
+    assert client.get('/user/2', headers=headers).json()['bio'] == 'from replica'
+
+    # a user's own writes are read back from the primary
+    assert client.patch('/user/', json={'bio': 'Foosball'}, headers=headers).status_code == 204
+    assert client.get('/user/2', headers=headers).json()['bio'] == 'Foosball'
+    forget_writers()
+
+def test_unhealthy_replica_falls_back_to_primary(tmp_path):
+    replica_set = ReplicaSet([replica_sessionmaker(f'sqlite+aiosqlite:///{tmp_path}/missing/replica.db')], check_interval=0, check_timeout=1)
+    assert replica_set.pick() is not None                           # unchecked yet, requests never wait for a check
+    asyncio.run(replica_set.check())
+    assert replica_set.pick() is None
+    assert replica_set.healthy == []
+
+def test_response_cache_generations():
+    forget_writers()
+    headers = {'Authorization': f'Bearer {auth_token}'}
+    first = client.get('/user/all', params={'limit': 1}, headers=headers)
+    cached = client.get('/user/all', params={'limit': 1}, headers=headers)
+    assert cached.content == first.content
+    assert cached.headers[COUNT_HEADER] == '0'
+
+    client.patch('/user/', json={'bio': 'Foosball'}, headers=headers)           # any user write bumps the list generation
+    forget_writers()
+    assert client.get('/user/all', params={'limit': 1}, headers=headers).headers[COUNT_HEADER] != '0'
+
+@pytest.mark.parametrize('backend', [MemoryCacheBackend, SQLiteCacheBackend, KVCacheBackend])
+def test_response_cache_backends(backend, tmp_path):
+    cache = ResponseCache(SQLiteCacheBackend(str(tmp_path / 'cache.sqlite')) if backend is SQLiteCacheBackend else backend(), ttl=60)
+
+    async def scenario():
+        key = await cache.key('user', 'public', ['user:7'], 7)
+        await cache.set(key, b'{}')
+        assert await cache.get(key) == b'{}'
+        await cache.bump(7)
+        assert await cache.key('user', 'public', ['user:7'], 7) != key
+        assert await cache.get(await cache.key('user', 'public', ['user:7'], 7)) is None
+    asyncio.run(scenario())
+
+def test_recent_writer_seen_by_every_worker(tmp_path):
+    path = str(tmp_path / 'cache.sqlite')
+    first, second = ResponseCache(SQLiteCacheBackend(path), ttl=60), ResponseCache(SQLiteCacheBackend(path), ttl=60)
+    asyncio.run(first.mark_writer('riyasen@gmail.com'))
+    assert asyncio.run(second.wrote_recently('riyasen@gmail.com'))
+    assert not asyncio.run(second.wrote_recently('premmehra@gmail.com'))
+
+def test_sqlite_response_cache_bounded(tmp_path, monkeypatch):
+    monkeypatch.setattr(SQLiteCacheBackend, 'PURGE_EVERY', 5)
+    backend = SQLiteCacheBackend(str(tmp_path / 'cache.sqlite'), maxsize=3)
+
+    async def fill():
+        for number in range(10):
+            await backend.set(f'key{number}', b'{}', 60 - number)         # the newest entries are kept, not the longest lived
+    asyncio.run(fill())
+    assert backend._connection().execute('SELECT key FROM entries ORDER BY key').fetchall() == [('key7',), ('key8',), ('key9',)]
+
+def test_failing_response_cache_is_a_miss():
+    class Broken(MemoryCacheBackend):
+        async def counter(self, key):
+            raise sqlite3.OperationalError('database is locked')
+        async def get(self, key):
+            raise sqlite3.OperationalError('database is locked')
+
+    cache = ResponseCache(Broken(), ttl=60)
+    assert asyncio.run(cache.key('user', 'public', ['user:7'], 7)) is None
+    assert asyncio.run(cache.get('response:user')) is None
+    asyncio.run(cache.set(None, b'{}'))
+
+def test_server_shares_response_cache_between_workers(monkeypatch):
+    import server
+    monkeypatch.setenv('RESPONSE_CACHE_BACKEND', '')                  # restored after the test
+    monkeypatch.delenv('RESPONSE_CACHE_BACKEND')
+    server.shared_response_cache(1)
+    assert 'RESPONSE_CACHE_BACKEND' not in os.environ
+    server.shared_response_cache(4)
+    assert os.environ['RESPONSE_CACHE_BACKEND'] == 'app.utils.response_cache.SQLiteCacheBackend'
+    monkeypatch.setenv('RESPONSE_CACHE_BACKEND', 'app.utils.response_cache.MemoryCacheBackend')
+    with pytest.raises(SystemExit):
+        server.shared_response_cache(4)
+
+def test_cache_backend_must_implement_every_method():
+    class GetOnly(CacheBackend):
+        def get(self, key):
+            return None
+    with pytest.raises(TypeError):
+        GetOnly()
+
+def test_batch_profiles_in_request_order():
+    headers = {'Authorization': f'Bearer {auth_token}'}
+    response = client.get('/user/batch', params={'ids': '2,999,1,2'}, headers=headers)
+    assert response.status_code == 200
+    assert int(response.headers[COUNT_HEADER]) <= 1
+    batch = response.json()
+    assert [item and item['email'] for item in batch['items']] == ['premmehra@gmail.com', None, 'chauashish21@gmail.com', 'premmehra@gmail.com']
+    assert batch['missing'] == [999]
+    assert client.get('/user/batch', params={'ids': '1,x'}, headers=headers).status_code == 400
+
+def test_outdated_hash_rehashed_after_login(monkeypatch):
+    monkeypatch.setattr(rate_limit, 'store', MemoryRateLimitStore())
+    weak_hash = hashing.pwd_context().handler().using(rounds=4).hash('hello123@dinoPG')
+    with TestingSessionLocal() as session:
+        session.add(User(first_name='Old', last_name='Hash', email='oldhash@gmail.com', password=weak_hash, is_verified=True))
+        session.commit()
+    assert hashing.needs_update(weak_hash)
+
+    response = client.post('/user/login', data={'username': 'oldhash@gmail.com', 'password': 'hello123@dinoPG'})
+    assert response.status_code == 200
+    assert int(response.headers[COUNT_HEADER]) <= 2             # the rehash runs after the response
+
+    with TestingSessionLocal() as session:
+        user = session.query(User).filter_by(email='oldhash@gmail.com').one()
+        assert user.password != weak_hash and not hashing.needs_update(user.password)
+        assert hashing.verify_password('hello123@dinoPG', user.password)
+
+def test_job_queue_dedup_retry_and_dead_letter(monkeypatch, smtp_sink):
+    monkeypatch.setattr(rate_limit, 'store', MemoryRateLimitStore())
+    run_jobs()
+    for _ in range(3):
+        assert client.post('/user/forgot-password', json='chauashish21@gmail.com').status_code == 200
+    with TestingSessionLocal() as session:
+        job = session.query(Job).filter_by(dedup_key='forgot-password:chauashish21@gmail.com').one()
+        assert json.loads(job.payload) == {'email': 'chauashish21@gmail.com', 'purpose': signed_token.RESET_PASSWORD}    # no usable link stored
+
+    async def smtp_down(payload, session_factory):
+        raise ConnectionError('smtp down')
+    monkeypatch.setitem(job_queue.HANDLERS, job_queue.SEND_LINK, smtp_down)
+    monkeypatch.setattr(settings, 'JOB_BACKOFF_BASE', 0)
+    for _ in range(settings.JOB_MAX_ATTEMPTS):
+        assert run_jobs() == 1
+    assert run_jobs() == 0
+    with TestingSessionLocal() as session:
+        job = session.query(Job).filter_by(status='dead').one()
+        assert (job.attempts, job.dedup_key, job.last_error) == (settings.JOB_MAX_ATTEMPTS, None, 'ConnectionError: smtp down')
+
+    monkeypatch.setattr(settings, 'JOB_BACKOFF_BASE', 5)
+    assert 10 <= job_queue.backoff(3) <= 20
+
+    # the dead job released its key, the next request is delivered
+    monkeypatch.setitem(job_queue.HANDLERS, job_queue.SEND_LINK, job_queue.send_link)
+    delivered = len(smtp_sink.messages)
+    assert client.post('/user/forgot-password', json='chauashish21@gmail.com').status_code == 200
+    assert run_jobs() == 1
+    envelope = next(envelope for envelope in smtp_sink.messages[delivered:] if 'chauashish21@gmail.com' in envelope.rcpt_tos)     # accepted before the job completed
+    assert b'/user/send-template?token=' in envelope.content
+    with TestingSessionLocal() as session:
+        assert session.query(Job).filter(Job.status != 'dead').count() == 0
+
+def test_verify_job_rolled_back_with_failed_signup(monkeypatch):
+    monkeypatch.setattr(rate_limit, 'store', MemoryRateLimitStore())
+    async def not_registered(self, email):
+        return False
+    monkeypatch.setattr(UserRepository, 'user_exist_with_email', not_registered)
+    response = client.post('/user/', json={'email': 'chauashish21@gmail.com', 'first_name': 'Dup', 'last_name': 'User', 'password': 'hello123@dinoPG'})
+    assert response.status_code == 500                              # unique email violated on insert
+    with TestingSessionLocal() as session:
+        assert session.query(Job).filter_by(dedup_key='verify-email:chauashish21@gmail.com').count() == 0
+
+def test_login_history_written_behind(monkeypatch):
+    monkeypatch.setattr(rate_limit, 'store', MemoryRateLimitStore())
+    asyncio.run(activity.flush(AsyncTestingSessionLocal))
+    with TestingSessionLocal() as session:
+        before = session.query(User).filter_by(email='chauashish21@gmail.com').one().updated_at
+
+    headers = {'User-Agent': 'history-test'}
+    assert client.post('/user/login', data={'username': 'chauashish21@gmail.com', 'password': 'wrong-password1'}, headers=headers).status_code == 401
+    response = client.post('/user/login', data={'username': 'chauashish21@gmail.com', 'password': 'hello123@dinoPG'}, headers=headers)
+    assert int(response.headers[COUNT_HEADER]) <= 2                 # nothing written synchronously
+    token = response.json()['access_token']
+    for _ in range(3):
+        client.get('/user/me', headers={'Authorization': f'Bearer {token}'})
+    assert activity.pending() == 3                                  # two events, the last seen updates coalesced
+
+    with track_queries() as stats:
+        assert asyncio.run(activity.flush(AsyncTestingSessionLocal)) == 2
+    assert stats.count == 2
+    with TestingSessionLocal() as session:
+        events = session.query(LoginEvent).filter_by(user_agent='history-test').order_by(LoginEvent.id).all()
+        assert [(event.succeeded, event.user_id is None) for event in events] == [(False, True), (True, False)]
+        user = session.query(User).filter_by(email='chauashish21@gmail.com').one()
+        assert user.last_login_at == events[1].created_at and user.last_seen_at >= user.last_login_at
+        assert user.updated_at == before                            # ETags and signed links are unaffected
+
+def test_activity_flushes_on_size():
+    async def scenario():
+        buffer = ActivityBuffer(size=3, interval=60)
+        buffer.start(AsyncTestingSessionLocal)
+        for _ in range(3):
+            buffer.login(None, 'nobody@example.com', False, '10.0.0.1', 'size-test')
+        await asyncio.sleep(0.5)
+        assert buffer.pending() == 0
+        buffer.login(None, 'nobody@example.com', False, '10.0.0.1', 'size-test')
+        await buffer.stop()                                         # flushes the rest
+        assert buffer.pending() == 0
+    asyncio.run(scenario())
+    with TestingSessionLocal() as session:
+        assert session.query(LoginEvent).filter_by(user_agent='size-test').count() == 4
+
 def test_user_delete():
+    forget_writers()
     response = client.delete('/user/2', headers={'Authorization': f'Bearer {auth_token}'})
     assert response.status_code == 204
+    assert asyncio.run(response_cache.wrote_recently('chauashish21@gmail.com'))              # the superuser who deleted reads from the primary
     # Check if the user is actually deleted
     response = client.get('/user/2', headers={'Authorization': f'Bearer {auth_token}'})
     assert response.status_code == 404
     assert response.json() == {'detail': 'user not found'}
 
+def test_mailer_reuses_connection(smtp_sink):
+    delivered = len(smtp_sink.messages)
+    futures = [send_email_background('Forgot Password Mail', f'user{i}@example.com', 'forgot_password_template.html', {'token': 't', 'data': 'd'}) for i in range(5)]
+    assert all(future.result(timeout=5) for future in futures)
+    assert len(smtp_sink.messages) == delivered + 5
+    assert len(set(smtp_sink.peers[delivered:])) <= settings.MAIL_POOL_SIZE
+
 def teardown():
     Base.metadata.drop_all(bind=engine)
\ No newline at end of file
@@ -0,0 +1,35 @@
+'''Background job entry point: python worker.py
+
+Runs the queued jobs (email delivery) outside the web workers, scale it with more processes
+or JOB_WORKER_CONCURRENCY independently of server.py.
+'''
+
+import asyncio
+import logging
+import signal
+
+
+def main() -> None:
+    from settings import settings
+    from app.config.database import AsyncSessionLocal
+    from app.utils.email_util import mailer
+    from app.utils.job_queue import Worker
+
+    logging.basicConfig(level=logging.DEBUG if settings.DEBUG else logging.INFO)
+    worker = Worker(AsyncSessionLocal, settings.JOB_WORKER_CONCURRENCY, settings.JOB_POLL_INTERVAL, settings.JOB_LEASE_SECONDS)
+
+    async def run() -> None:
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, stop.set)           # finish the running jobs, the rest stay queued
+        await worker.run(stop)
+
+    try:
+        asyncio.run(run())
+    finally:
+        mailer.stop()
+
+
+if __name__ == '__main__':
+    main()